@@ -44,6 +44,7 @@ from widgets import BrowserNotebook
 from palettes import ContentInvoker
 from filepicker import FilePicker
 import globalhistory
+import topsites
 from pdfviewer import PDFTabPage
 
 # Sugar is relative to 100x (XO), the web is relative to 72x (desktop) scale
@@ -390,6 +391,8 @@ class TabbedView(BrowserNotebook):
         browser = self.add_tab()
         if uri is not None:
             browser.load_uri(uri)
+        else:
+            browser.load_uri(topsites.URI)
 
     def close_tab(self, tab_page=None):
         if self.get_n_pages() == 1:
@@ -718,6 +721,8 @@ class Browser(WebKit2.WebView):
 
         # Reference to the global history and callbacks to handle it:
         self._global_history = globalhistory.get_global_history()
+        self._navigation = globalhistory.NavigationTracker(
+            self._global_history)
         self.connect('load-changed', self.__load_changed_cb)
         self.connect('notify::title', self.__title_changed_cb)
         self.connect('decide-policy', self.__decide_policy_cb)
@@ -844,10 +849,14 @@ class Browser(WebKit2.WebView):
         return True
 
     def __load_changed_cb(self, widget, status):
-        if status <= WebKit2.LoadEvent.COMMITTED:
-            # Add the url to the global history or update it.
-            uri = self.get_uri()
-            self._global_history.add_page(uri)
+        # Add the url to the global history or update it, once per
+        # navigation.
+        if status == WebKit2.LoadEvent.STARTED:
+            self._navigation.start(self.get_uri())
+        elif status == WebKit2.LoadEvent.REDIRECTED:
+            self._navigation.redirect(self.get_uri())
+        elif status == WebKit2.LoadEvent.COMMITTED:
+            self._navigation.commit(self.get_uri())
 
         self.cached_uri = self.props.uri
 
@@ -16,30 +16,125 @@
 
 from datetime import datetime
 
+from gi.repository import GLib
+
 import places
+import topsites
 
 _global_history = None
 
 
+class Visit(object):
+    ''' A navigation, from the first requested uri to the committed one
+
+    redirects -- the uris that redirected to the final uri, in order
+    '''
+
+    def __init__(self, uri, redirects=None):
+        self.uri = uri
+        self.redirects = redirects or []
+        self.timestamp = datetime.now()
+
+
+class NavigationTracker(object):
+    ''' Follow the load events of a browser tab, so that a navigation
+    and all its redirect hops are recorded as a single visit.
+    '''
+
+    def __init__(self, global_history):
+        self._global_history = global_history
+        self._uri = None
+        self._redirects = []
+        self._committed_uri = None
+
+    def start(self, uri):
+        # Leaving the page, its title won't change anymore
+        if self._committed_uri is not None:
+            self._global_history.flush_page_title(self._committed_uri)
+            self._committed_uri = None
+
+        self._uri = uri
+        self._redirects = []
+
+    def redirect(self, uri):
+        if self._uri is not None:
+            self._redirects.append(self._uri)
+        self._uri = uri
+
+    def commit(self, uri):
+        if self._uri is not None and self._uri != uri:
+            self._redirects.append(self._uri)
+
+        self._global_history.add_visit(Visit(uri, self._redirects))
+        self._committed_uri = uri
+        self._uri = None
+        self._redirects = []
+
+
 class GlobalHistory(object):
+    # Some pages keep changing their title (unread counts, timers), so
+    # a title is only written once it didn't change for TITLE_DELAY,
+    # or when the page is left.  suppressed_titles counts the titles
+    # that were replaced before being written.
+    TITLE_DELAY = 2  # seconds
+
     def __init__(self):
         self._store = places.get_store()
+        # uri -> (title, source id of the write)
+        self._titles = {}
+        self.suppressed_titles = 0
 
     def add_page(self, uri):
-        place = self._store.lookup_place(uri)
-        if place:
-            place.visits += 1
-            place.last_visit = datetime.now()
-            self._store.update_place(place)
+        self.add_visit(Visit(uri))
+
+    def add_visit(self, visit):
+        if visit.uri.startswith(topsites.SCHEME + ':'):
+            return
+
+        if visit.redirects:
+            transition = places.TRANSITION_REDIRECT
         else:
-            place = places.Place(uri)
-            self._store.add_place(place)
+            transition = places.TRANSITION_LINK
+        self._store.record_visit(visit.uri, visit.timestamp, transition,
+                                 visit.redirects)
 
     def set_page_title(self, uri, title):
-        place = self._store.lookup_place(uri)
-        if place:
-            place.title = title
-            self._store.update_place(place)
+        pending = self._titles.get(uri)
+        if pending is not None:
+            if pending[0] == title:
+                return
+            GLib.source_remove(pending[1])
+            self.suppressed_titles += 1
+
+        sid = GLib.timeout_add_seconds(self.TITLE_DELAY,
+                                       self.__title_settled_cb, uri)
+        self._titles[uri] = (title, sid)
+
+    def __title_settled_cb(self, uri):
+        title, sid_ = self._titles.pop(uri)
+        self._store.set_place_title(uri, title)
+        return False
+
+    def flush_page_title(self, uri):
+        ''' Write the title of the page now, if it is waiting '''
+        pending = self._titles.pop(uri, None)
+        if pending is not None:
+            GLib.source_remove(pending[1])
+            self._store.set_place_title(uri, pending[0])
+
+    def flush(self):
+        ''' Write the titles and the visits that are waiting '''
+        for uri in list(self._titles):
+            self.flush_page_title(uri)
+        self._store.flush()
+
+    def close(self):
+        ''' Write what is waiting and close the history, when Browse
+        exits
+        '''
+        for uri in list(self._titles):
+            self.flush_page_title(uri)
+        self._store.close()
 
 
 def get_global_history():
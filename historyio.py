@@ -0,0 +1,195 @@
+# Copyright (C) 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''Import and export the places history, as JSON lines or as a
+Netscape bookmarks HTML file.
+
+The places are streamed, so histories of any size can be moved
+between machines or restored from a backup:
+
+    python3 historyio.py export history.jsonl
+    python3 historyio.py import history.html --db /path/to/places.db
+'''
+
+import sys
+import json
+import argparse
+from datetime import datetime
+from html import escape
+from html.parser import HTMLParser
+
+import places
+
+_READ_SIZE = 64 * 1024
+
+_HTML_HEADER = '''<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<TITLE>Browse History</TITLE>
+<H1>Browse History</H1>
+<DL><p>
+'''
+_HTML_FOOTER = '''</DL><p>
+'''
+
+
+def _to_epoch(value):
+    timestamp = places.parse_timestamp(value)
+    if timestamp is None:
+        return 0
+    return int(timestamp.timestamp())
+
+
+def export_jsonl(store, fileobj):
+    count = 0
+    for place in store.iter_places():
+        fileobj.write(json.dumps({'uri': place.uri,
+                                  'title': place.title,
+                                  'visits': place.visits,
+                                  'last_visit': place.last_visit}))
+        fileobj.write('\n')
+        count += 1
+    return count
+
+
+def read_jsonl(fileobj):
+    for line in fileobj:
+        line = line.strip()
+        if not line:
+            continue
+        data = json.loads(line)
+        if not data.get('uri'):
+            continue
+        yield places.Place(data['uri'], title=data.get('title') or '',
+                           visits=data.get('visits') or 1,
+                           last_visit=places.parse_timestamp(
+                               data.get('last_visit')))
+
+
+def import_jsonl(store, fileobj):
+    return store.import_places(read_jsonl(fileobj))
+
+
+def export_html(store, fileobj):
+    count = 0
+    fileobj.write(_HTML_HEADER)
+    for place in store.iter_places():
+        last_visit = _to_epoch(place.last_visit)
+        fileobj.write('    <DT><A HREF="%s" ADD_DATE="%d" LAST_VISIT="%d" '
+                      'VISIT_COUNT="%d">%s</A>\n' % (
+                          escape(place.uri), last_visit, last_visit,
+                          place.visits or 0, escape(place.title or '')))
+        count += 1
+    fileobj.write(_HTML_FOOTER)
+    return count
+
+
+class _BookmarksParser(HTMLParser):
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.places = []
+        self._place = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+
+        attrs = dict(attrs)
+        if not attrs.get('href'):
+            return
+
+        last_visit = attrs.get('last_visit') or attrs.get('add_date')
+        try:
+            last_visit = datetime.fromtimestamp(int(last_visit))
+        except (TypeError, ValueError):
+            last_visit = None
+        try:
+            visits = int(attrs.get('visit_count'))
+        except (TypeError, ValueError):
+            visits = 1
+
+        self._place = places.Place(attrs['href'], visits=visits,
+                                   last_visit=last_visit)
+
+    def handle_data(self, data):
+        if self._place is not None:
+            self._place.title += data
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._place is not None:
+            self._place.title = self._place.title.strip()
+            self.places.append(self._place)
+            self._place = None
+
+
+def read_html(fileobj):
+    parser = _BookmarksParser()
+    while True:
+        data = fileobj.read(_READ_SIZE)
+        if not data:
+            break
+        parser.feed(data)
+        yield from parser.places
+        parser.places = []
+    parser.close()
+    yield from parser.places
+
+
+def import_html(store, fileobj):
+    return store.import_places(read_html(fileobj))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import or export the Browse history')
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('file', help='JSON lines (.jsonl) or HTML file, '
+                        'or - for the standard input or output')
+    parser.add_argument('--format', choices=['jsonl', 'html'],
+                        help='guessed from the file name by default')
+    parser.add_argument('--db', help='places database, by default the one '
+                        'of the activity')
+    args = parser.parse_args()
+
+    format_ = args.format
+    if format_ is None:
+        if args.file.lower().endswith(('.html', '.htm')):
+            format_ = 'html'
+        else:
+            format_ = 'jsonl'
+
+    store = places.SqliteStore(args.db)
+
+    if args.action == 'export':
+        export = export_html if format_ == 'html' else export_jsonl
+        if args.file == '-':
+            count = export(store, sys.stdout)
+        else:
+            with open(args.file, 'w', encoding='utf-8') as fileobj:
+                count = export(store, fileobj)
+    else:
+        import_ = import_html if format_ == 'html' else import_jsonl
+        if args.file == '-':
+            count = import_(store, sys.stdin)
+        else:
+            with open(args.file, 'r', encoding='utf-8') as fileobj:
+                count = import_(store, fileobj)
+
+    print('%s %d places' % ('Exported' if args.action == 'export'
+                            else 'Imported', count), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
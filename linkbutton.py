@@ -18,11 +18,16 @@
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
 from gi.repository import Rsvg
 
 import os
-import io
+import time
+import logging
 import cairo
+from collections import OrderedDict
+from functools import partial
 from gettext import gettext as _
 import re
 
@@ -31,8 +36,105 @@ from sugar3.graphics.palettemenu import PaletteMenuItem
 from sugar3.graphics.palettemenu import PaletteMenuBox
 from sugar3.graphics.palette import Palette
 from sugar3.graphics.tray import TrayButton
+from sugar3.graphics.icon import Icon
 from sugar3.graphics import style
 
+from model import get_thumb
+
+
+class _ThumbLoader(object):
+    ''' Compose the thumbnails of the link buttons on idle, a few at a
+    time, the visible buttons first.
+    '''
+
+    # Time spent on each idle call
+    CHUNK_DURATION = 0.02  # seconds
+
+    def __init__(self):
+        self._buttons = OrderedDict()
+        self._sid = None
+
+    def add(self, button, visible=False):
+        self._buttons[button] = None
+        if visible:
+            self._buttons.move_to_end(button, last=False)
+        if self._sid is None:
+            self._sid = GLib.idle_add(self.__load_cb,
+                                      priority=GLib.PRIORITY_LOW)
+
+    def __load_cb(self):
+        end = time.monotonic() + self.CHUNK_DURATION
+        while self._buttons and time.monotonic() < end:
+            button, value_ = self._buttons.popitem(last=False)
+            button.load_thumb()
+
+        if self._buttons:
+            return True
+        self._sid = None
+        return False
+
+
+_thumb_loader = _ThumbLoader()
+
+# The link backgrounds rendered for the colors of the buddies, shared
+# by all the buttons
+_BACKGROUNDS_SIZE = 16
+_backgrounds = OrderedDict()
+_link_svg = None
+
+
+def _load_thumb(buf):
+    ''' Decode a thumbnail, JPEG or PNG for the older ones, or return
+    None if it is corrupted
+    '''
+    loader = GdkPixbuf.PixbufLoader()
+    try:
+        loader.write(buf)
+        loader.close()
+    except GLib.Error as error:
+        logging.warning('Could not load a link thumbnail: %s',
+                        error.message)
+        return None
+    return loader.get_pixbuf()
+
+
+def _get_link_background(fill, stroke):
+    ''' Return the link background for the colors, which must not be
+    drawn on
+    '''
+    link_width, link_height = style.zoom(120), style.zoom(110)
+    key = (fill, stroke, link_width, link_height)
+    surface = _backgrounds.get(key)
+    if surface is not None:
+        _backgrounds.move_to_end(key)
+        return surface
+
+    global _link_svg
+    if _link_svg is None:
+        filename = os.path.join(os.path.dirname(__file__), 'icons/link.svg')
+        with open(filename, 'rb') as icon_file:
+            _link_svg = icon_file.read()
+
+    entity = b'<!ENTITY fill_color "%s">' % fill.encode()
+    data = re.sub(b'<!ENTITY fill_color .*>', entity, _link_svg)
+
+    entity = b'<!ENTITY stroke_color "%s">' % stroke.encode()
+    data = re.sub(b'<!ENTITY stroke_color .*>', entity, data)
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                 link_width, link_height)
+    link_context = cairo.Context(surface)
+    link_scale_w = link_width * 1.0 / 120
+    link_scale_h = link_height * 1.0 / 110
+    link_context.scale(link_scale_w, link_scale_h)
+    handler = Rsvg.Handle.new_from_data(data)
+    handler.render_cairo(link_context)
+
+    _backgrounds[key] = surface
+    if len(_backgrounds) > _BACKGROUNDS_SIZE:
+        _backgrounds.popitem(last=False)
+    return surface
+
 
 class LinkButton(TrayButton, GObject.GObject):
     __gtype_name__ = 'LinkButton'
@@ -47,77 +149,105 @@ class LinkButton(TrayButton, GObject.GObject):
     _dest_y = style.zoom(20)
 
     def __init__(self, buf, color, title, owner, hash, notes=None):
+        ''' buf is the JPEG data of the thumbnail, PNG for older links,
+        or a function that returns it.  The function is called on idle,
+        once the button is drawn, and a placeholder is shown meanwhile.
+        '''
         TrayButton.__init__(self)
 
-        self._fill, self._stroke = color.split(',')
-        self.set_image(buf)
+        self._get_buf = None
+        self.connect('destroy', self.__destroy_cb)
 
         self.hash = hash
         self.notes = notes
         info = title + '\n' + owner
         self.setup_rollover_options(info)
+        self._set_thumb(buf, color)
+
+    def set_link(self, buf, color, title, owner, hash, notes=None):
+        ''' Show another link, for a button that is reused '''
+        self.hash = hash
+        self.notes = notes
+        self.get_palette().props.primary_text = title + '\n' + owner
+        self._set_notes_text()
+        self._set_thumb(buf, color)
+
+    def _set_thumb(self, buf, color):
+        self._fill, self._stroke = color.split(',')
+        if callable(buf):
+            self._get_buf = buf
+            self._set_placeholder()
+        else:
+            self._get_buf = None
+            self.set_image(buf)
 
     def get_image_coords(self, relative_to):
         return self._img.translate_coordinates(
             relative_to, self._dest_x, self._dest_y)
 
     def show_thumb(self):
+        self.load_thumb()
         self._img.set_from_pixbuf(self._pixbuf_bg)
 
     def hide_thumb(self):
-        xo_buddy = os.path.join(os.path.dirname(__file__), "icons/link.svg")
-        bg_surface = self._read_link_background(xo_buddy)
+        self.load_thumb()
+        bg_surface = _get_link_background(self._fill, self._stroke)
         bg_width, bg_height = style.zoom(120), style.zoom(110)
         pixbuf = Gdk.pixbuf_get_from_surface(bg_surface, 0, 0,
                                              bg_width, bg_height)
         self._img.set_from_pixbuf(pixbuf)
 
-    def set_image(self, buf):
+    def _set_placeholder(self):
         self._img = Gtk.Image()
-        str_buf = io.BytesIO(buf)
-        thumb_surface = cairo.ImageSurface.create_from_png(str_buf)
+        self._img.set_size_request(style.zoom(120), style.zoom(110))
+        self._img.connect('draw', self.__placeholder_draw_cb)
+        self.set_icon_widget(self._img)
+        self._img.show()
 
-        xo_buddy = os.path.join(os.path.dirname(__file__), "icons/link.svg")
+    def __placeholder_draw_cb(self, image, cr):
+        if self._get_buf is not None:
+            _thumb_loader.add(self, visible=True)
+        return False
 
-        bg_surface = self._read_link_background(xo_buddy)
+    def __destroy_cb(self, button):
+        self._get_buf = None
 
-        cairo_context = cairo.Context(bg_surface)
-        cairo_context.set_source_surface(thumb_surface,
-                                         self._dest_x, self._dest_y)
-        thumb_width, thumb_height = style.zoom(100), style.zoom(80)
-        cairo_context.rectangle(self._dest_x, self._dest_y,
-                                thumb_width, thumb_height)
-        cairo_context.fill()
+    def load_thumb(self):
+        if self._get_buf is None:
+            return
+
+        get_buf, self._get_buf = self._get_buf, None
+        self.set_image(get_buf())
+
+    def set_image(self, buf):
+        self._img = Gtk.Image()
 
         bg_width, bg_height = style.zoom(120), style.zoom(110)
+        # Draw on a copy of the shared background
+        bg_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                        bg_width, bg_height)
+        cairo_context = cairo.Context(bg_surface)
+        cairo_context.set_source_surface(
+            _get_link_background(self._fill, self._stroke), 0, 0)
+        cairo_context.paint()
+
+        # The thumbnail can be missing from the store, for a journal
+        # entry copied from another computer
+        thumb_pixbuf = _load_thumb(buf) if buf else None
+        if thumb_pixbuf is not None:
+            Gdk.cairo_set_source_pixbuf(cairo_context, thumb_pixbuf,
+                                        self._dest_x, self._dest_y)
+            thumb_width, thumb_height = style.zoom(100), style.zoom(80)
+            cairo_context.rectangle(self._dest_x, self._dest_y,
+                                    thumb_width, thumb_height)
+            cairo_context.fill()
+
         self._pixbuf_bg = Gdk.pixbuf_get_from_surface(bg_surface, 0, 0,
                                                       bg_width, bg_height)
         self._img.set_from_pixbuf(self._pixbuf_bg)
         self.set_icon_widget(self._img)
         self._img.show()
 
-    def _read_link_background(self, filename):
-        icon_file = open(filename, 'rb')
-        data = icon_file.read()
-        icon_file.close()
-
-        entity = b'<!ENTITY fill_color "%s">' % self._fill.encode()
-        data = re.sub(b'<!ENTITY fill_color .*>', entity, data)
-
-        entity = b'<!ENTITY stroke_color "%s">' % self._stroke.encode()
-        data = re.sub(b'<!ENTITY stroke_color .*>', entity, data)
-
-        link_width, link_height = style.zoom(120), style.zoom(110)
-        link_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                          link_width, link_height)
-        link_context = cairo.Context(link_surface)
-        link_scale_w = link_width * 1.0 / 120
-        link_scale_h = link_height * 1.0 / 110
-        link_context.scale(link_scale_w, link_scale_h)
-        handler = Rsvg.Handle.new_from_data(data)
-        handler.render_cairo(link_context)
-        return link_surface
-
     def setup_rollover_options(self, info):
         palette = Palette(info, text_maxlen=50)
         self.set_palette(palette)
@@ -143,12 +273,18 @@ class LinkButton(TrayButton, GObject.GObject):
         box.append_item(textview)
         textview.show()
 
-        buffer = textview.get_buffer()
+        self._notes_buffer = textview.get_buffer()
+        self._notes_changed_sid = self._notes_buffer.connect(
+            'changed', self.__buffer_changed_cb)
+        self._set_notes_text()
+
+    def _set_notes_text(self):
+        self._notes_buffer.handler_block(self._notes_changed_sid)
         if self.notes is None:
-            buffer.set_text(_('Take notes on this page'))
+            self._notes_buffer.set_text(_('Take notes on this page'))
         else:
-            buffer.set_text(self.notes)
-        buffer.connect('changed', self.__buffer_changed_cb)
+            self._notes_buffer.set_text(self.notes)
+        self._notes_buffer.handler_unblock(self._notes_changed_sid)
 
     def item_remove_cb(self, widget):
         self.emit('remove_link', self.hash)
@@ -157,3 +293,208 @@ class LinkButton(TrayButton, GObject.GObject):
         start, end = buffer.get_bounds()
         self.notes = buffer.get_text(start, end, False)
         self.notes_changed_signal.emit(self.hash, self.notes)
+
+
+class LinkTray(Gtk.Box):
+    ''' The tray of the shared links of a Model
+
+    Only the links that fit in the tray have a button, and the buttons
+    are reused to show other links as the tray is scrolled.  The links
+    can be filtered by their title, owner and notes.
+    '''
+
+    __gsignals__ = {
+        'link-clicked': (GObject.SignalFlags.RUN_FIRST, None, ([str])),
+        'remove-link': (GObject.SignalFlags.RUN_FIRST, None, ([str])),
+        'notes-changed': (GObject.SignalFlags.RUN_FIRST, None,
+                          ([str, str])),
+    }
+
+    def __init__(self, model):
+        Gtk.Box.__init__(self, orientation=Gtk.Orientation.HORIZONTAL,
+                         spacing=style.DEFAULT_SPACING)
+
+        self._model = model
+        self._model.add_link_signal.connect(self.__model_changed_cb)
+        self._model.add_links_signal.connect(self.__model_changed_cb)
+        self._model.link_removed_signal.connect(self.__model_changed_cb)
+
+        # The links that are shown, when they are filtered
+        self._filtered = None
+        # Index of the link of the first button
+        self._offset = 0
+        self._buttons = []
+        # The link shown by each button
+        self._button_links = []
+        self._resize_sid = None
+
+        self._entry = Gtk.SearchEntry()
+        self._entry.props.placeholder_text = _('Filter')
+        self._entry.props.valign = Gtk.Align.CENTER
+        self._entry.connect('search-changed', self.__search_changed_cb)
+        self.pack_start(self._entry, False, False, 0)
+        self._entry.show()
+
+        self._previous = self._add_arrow('go-left', -1)
+
+        # The buttons are in a scrolled window without scrollbars, so
+        # the tray can be made smaller than the buttons, and then shows
+        # less of them
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_policy(Gtk.PolicyType.EXTERNAL,
+                                   Gtk.PolicyType.NEVER)
+        scrolled_window.set_shadow_type(Gtk.ShadowType.NONE)
+        scrolled_window.connect('size-allocate', self.__size_allocate_cb)
+        scrolled_window.connect('scroll-event', self.__scroll_event_cb)
+        self.pack_start(scrolled_window, True, True, 0)
+        scrolled_window.show()
+
+        self._button_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        scrolled_window.add(self._button_box)
+        self._button_box.show()
+
+        self._next = self._add_arrow('go-right', 1)
+
+        self._set_button_count(1)
+
+    def _add_arrow(self, icon_name, step):
+        button = Gtk.Button()
+        button.props.relief = Gtk.ReliefStyle.NONE
+        button.add(Icon(icon_name=icon_name,
+                        pixel_size=style.SMALL_ICON_SIZE))
+        button.get_child().show()
+        button.connect('clicked', self.__arrow_clicked_cb, step)
+        self.pack_start(button, False, False, 0)
+        button.show()
+        return button
+
+    def get_links(self):
+        ''' Return the links that are shown, in order '''
+        if self._filtered is not None:
+            return self._filtered
+        return self._model.data['shared_links']
+
+    def update(self):
+        ''' Show the links of the model, once they are all replaced '''
+        self._refilter()
+        self._update_buttons()
+
+    def show_link(self, hash):
+        ''' Scroll to the link and return its button, or None if the
+        link is filtered out
+        '''
+        for index, link in enumerate(self.get_links()):
+            if link['hash'] == hash:
+                break
+        else:
+            return None
+        if not self._buttons:
+            return None
+
+        if index < self._offset:
+            self._offset = index
+        elif index >= self._offset + len(self._buttons):
+            self._offset = index - len(self._buttons) + 1
+        self._update_buttons()
+        return self._buttons[index - self._offset]
+
+    def _refilter(self):
+        text = self._entry.get_text()
+        if text:
+            self._filtered = self._model.filter_links(text)
+        else:
+            self._filtered = None
+
+    def _update_buttons(self):
+        links = self.get_links()
+        self._offset = max(0, min(self._offset,
+                                  len(links) - len(self._buttons)))
+
+        for index, button in enumerate(self._buttons):
+            if self._offset + index >= len(links):
+                self._button_links[index] = None
+                button.hide()
+                continue
+
+            link = links[self._offset + index]
+            if self._button_links[index] is not link:
+                self._button_links[index] = link
+                button.set_link(partial(get_thumb, link), link['color'],
+                                link['title'], link['owner'], link['hash'],
+                                link.get('notes'))
+            button.show()
+
+        self._previous.props.sensitive = self._offset > 0
+        self._next.props.sensitive = \
+            self._offset + len(self._buttons) < len(links)
+
+    def _set_button_count(self, count):
+        while len(self._buttons) < count:
+            button = LinkButton(None, '#000000,#000000', '', '', '')
+            button.connect('clicked', self.__button_clicked_cb)
+            button.connect('remove_link', self.__button_remove_cb)
+            button.notes_changed_signal.connect(self.__notes_changed_cb)
+            self._button_box.pack_start(button, False, False, 0)
+            self._buttons.append(button)
+            self._button_links.append(None)
+
+        while len(self._buttons) > count:
+            self._buttons.pop().destroy()
+            self._button_links.pop()
+
+        self._update_buttons()
+
+    def __size_allocate_cb(self, scrolled_window, allocation):
+        button_width = self._buttons[0].get_preferred_width()[1]
+        count = max(1, allocation.width // max(1, button_width))
+        if count != len(self._buttons) and self._resize_sid is None:
+            # Changing the buttons while allocating would allocate
+            # again at once
+            self._resize_sid = GLib.idle_add(self.__resize_cb, count)
+
+    def __resize_cb(self, count):
+        self._resize_sid = None
+        self._set_button_count(count)
+        return False
+
+    def __arrow_clicked_cb(self, button, step):
+        self._offset += step
+        self._update_buttons()
+
+    def __scroll_event_cb(self, scrolled_window, event):
+        # Scroll by links rather than by pixels
+        if event.direction in (Gdk.ScrollDirection.UP,
+                               Gdk.ScrollDirection.LEFT):
+            self._offset -= 1
+        elif event.direction in (Gdk.ScrollDirection.DOWN,
+                                 Gdk.ScrollDirection.RIGHT):
+            self._offset += 1
+        else:
+            ok, delta_x, delta_y = event.get_scroll_deltas()
+            delta = delta_x or delta_y
+            if delta < 0:
+                self._offset -= 1
+            elif delta > 0:
+                self._offset += 1
+        self._update_buttons()
+        return True
+
+    def __search_changed_cb(self, entry):
+        self._offset = 0
+        self.update()
+
+    def __model_changed_cb(self, model, *args):
+        self.update()
+
+    def __button_clicked_cb(self, button):
+        link = self._button_links[self._buttons.index(button)]
+        if link is not None:
+            self.emit('link-clicked', link['url'])
+
+    def __button_remove_cb(self, button, hash):
+        self.emit('remove-link', hash)
+
+    def __notes_changed_cb(self, button, hash, notes):
+        self.emit('notes-changed', hash, notes)
+        if self._filtered is not None:
+            self._refilter()
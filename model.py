@@ -16,9 +16,101 @@
 #    Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import json
+from base64 import b64decode, b64encode
+from bisect import bisect_left
 from gi.repository import GObject
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
 from hashlib import sha1
 
+import thumbstore
+
+
+def _store_thumb(link):
+    ''' Move the inline thumbnail of a link to the thumbnail store
+
+    The links of the journal entries of previous versions, and the
+    links received from the buddies, have their thumbnail inline.
+    '''
+    thumb = link.pop('thumb', None)
+    if thumb:
+        link['thumb_id'] = thumbstore.put(b64decode(thumb))
+    elif thumb is not None:
+        link['thumb_id'] = None
+    return link
+
+
+def get_thumb(link):
+    ''' Return the image data of the thumbnail of a link, or None '''
+    return thumbstore.get(link.get('thumb_id'))
+
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_empty_png = None
+
+
+def _get_empty_png():
+    global _empty_png
+    if _empty_png is None:
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8,
+                                      1, 1)
+        pixbuf.fill(0)
+        success, _empty_png = pixbuf.save_to_bufferv('png', [], [])
+    return _empty_png
+
+
+def encode_wire_thumb(thumb):
+    ''' Return the thumbnail as base64 PNG, to send it to the buddies
+
+    The previous versions of Browse only read PNG thumbnails and fail
+    on a missing one, so the thumbnails stored as JPEG are converted,
+    and an empty image is sent for a missing one.
+    '''
+    if thumb and not thumb.startswith(_PNG_SIGNATURE):
+        loader = GdkPixbuf.PixbufLoader()
+        try:
+            loader.write(thumb)
+            loader.close()
+            success, thumb = loader.get_pixbuf().save_to_bufferv(
+                'png', [], [])
+        except GLib.Error:
+            thumb = None
+    if not thumb:
+        thumb = _get_empty_png()
+    return b64encode(thumb).decode('ascii')
+
+
+def export_link(link):
+    ''' Return a copy of a link with its thumbnail inline, to send it
+    to the buddies
+    '''
+    link = dict(link)
+    link['thumb'] = encode_wire_thumb(get_thumb(link))
+    return link
+
+
+def reconcile(local_links, remote_links):
+    ''' Compare two lists of shared links by their hash
+
+    Return the links that are only in remote_links, to add locally,
+    the links that are only in local_links, to push to the peers, and
+    the (local, remote) pairs of links that are in both lists but
+    with different notes.
+    '''
+    local = {}
+    for link in local_links:
+        local.setdefault(link['hash'], link)
+    remote = {}
+    for link in remote_links:
+        remote.setdefault(link['hash'], link)
+
+    to_add = [link for hash, link in remote.items() if hash not in local]
+    to_push = [link for hash, link in local.items() if hash not in remote]
+    shared = local.keys() & remote.keys()
+    conflicts = [(local[hash], remote[hash]) for hash in shared
+                 if local[hash].get('notes') != remote[hash].get('notes')]
+    return to_add, to_push, conflicts
+
 
 class Model(GObject.GObject):
     ''' The model of web-activity which uses json to serialize its data
@@ -26,21 +118,38 @@ class Model(GObject.GObject):
     '''
 
     add_link_signal = GObject.Signal('add_link', arg_types=[int, bool])
+    add_links_signal = GObject.Signal('add-links',
+                                      arg_types=[int, int, bool])
     link_removed_signal = GObject.Signal('link-removed')
 
     def __init__(self):
         GObject.GObject.__init__(self)
         self.data = {}
         self.data['shared_links'] = []
+        # hash -> the shared links with that hash, in insertion order
+        self._links_by_hash = {}
+        # The timestamps of the shared links, which are kept sorted
+        self._timestamps = []
+        # id of a shared link -> its text matched by filter_links()
+        self._search_texts = {}
+
+    def _index_link(self, link):
+        self._links_by_hash.setdefault(link['hash'], []).append(link)
+
+    def _reindex(self):
+        self.data['shared_links'].sort(key=lambda link: link['timestamp'])
+        self._timestamps = [link['timestamp']
+                            for link in self.data['shared_links']]
+        self._links_by_hash = {}
+        self._search_texts = {}
+        for link in self.data['shared_links']:
+            self._index_link(link)
 
     def has_link(self, uri):
-        '''returns true if the uri is already bookmarked, O(n) oddly'''
+        '''returns true if the uri is already bookmarked'''
         if uri is None:
             return False
-        for link in self.data['shared_links']:
-            if link['hash'] == sha1(uri.encode()).hexdigest():
-                return True
-        return False
+        return sha1(uri.encode()).hexdigest() in self._links_by_hash
 
     def add_link(self, url, title, thumb, owner, color, timestamp,
                  by_me=False):
@@ -55,26 +164,81 @@ class Model(GObject.GObject):
         self.add_link_from_info(info, by_me)
 
     def add_link_from_info(self, info_dict, by_me=False):
-        index = len(self.data['shared_links'])
-        for item in self.data['shared_links']:
-            if info_dict['timestamp'] <= item['timestamp']:
-                index = self.data['shared_links'].index(item)
-                break
-
+        _store_thumb(info_dict)
+        index = bisect_left(self._timestamps, info_dict['timestamp'])
         self.data['shared_links'].insert(index, info_dict)
+        self._timestamps.insert(index, info_dict['timestamp'])
+        self._index_link(info_dict)
         self.add_link_signal.emit(index, by_me)
 
+    def add_links_from_info(self, infos, by_me=False):
+        ''' Merge several links at once
+
+        A single add-links signal gives the start and end of the range
+        of indexes where the links were inserted, the range can also
+        hold links that were already there.
+        '''
+        if not infos:
+            return
+
+        infos = sorted([_store_thumb(info) for info in infos],
+                       key=lambda info: info['timestamp'])
+        links = self.data['shared_links']
+        start = bisect_left(self._timestamps, infos[0]['timestamp'])
+
+        merged = []
+        index = start
+        for info in infos:
+            next_index = bisect_left(self._timestamps, info['timestamp'],
+                                     index)
+            merged.extend(links[index:next_index])
+            merged.append(info)
+            index = next_index
+            self._index_link(info)
+
+        links[start:index] = merged
+        self._timestamps[start:index] = [link['timestamp']
+                                         for link in merged]
+        self.add_links_signal.emit(start, start + len(merged), by_me)
+
     def remove_link(self, hash):
-        for link in self.data['shared_links']:
-            if link['hash'] == hash:
-                self.data['shared_links'].remove(link)
-                self.link_removed_signal.emit()
-                break
+        links = self._links_by_hash.get(hash)
+        if not links:
+            return
+
+        link = links.pop(0)
+        if not links:
+            del self._links_by_hash[hash]
+
+        index = bisect_left(self._timestamps, link['timestamp'])
+        while self.data['shared_links'][index] is not link:
+            index += 1
+        del self.data['shared_links'][index]
+        del self._timestamps[index]
+        self._search_texts.pop(id(link), None)
+        self.link_removed_signal.emit()
 
     def change_link_notes(self, hash, notes):
-        for link in self.data['shared_links']:
-            if link['hash'] == hash:
-                link['notes'] = notes
+        for link in self._links_by_hash.get(hash, []):
+            link['notes'] = notes
+            self._search_texts.pop(id(link), None)
+
+    def filter_links(self, text):
+        ''' Return the shared links with the text in their title, owner
+        or notes, in order
+        '''
+        text = text.lower()
+        return [link for link in self.data['shared_links']
+                if text in self._get_search_text(link)]
+
+    def _get_search_text(self, link):
+        search_text = self._search_texts.get(id(link))
+        if search_text is None:
+            search_text = '\n'.join([link.get('title') or '',
+                                     link.get('owner') or '',
+                                     link.get('notes') or '']).lower()
+            self._search_texts[id(link)] = search_text
+        return search_text
 
     def serialize(self):
         return json.dumps(self.data)
@@ -82,10 +246,6 @@ class Model(GObject.GObject):
     def deserialize(self, data):
         self.data = json.loads(data)
         self.data.setdefault('shared_links', [])
-
-    def get_links_ids(self):
-        ids = []
         for link in self.data['shared_links']:
-            ids.append(link['hash'])
-        ids.append('')
-        return ids
+            _store_thumb(link)
+        self._reindex()
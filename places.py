@@ -15,35 +15,282 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import logging
+import time
 import sqlite3
+import threading
+import itertools
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
 from datetime import datetime, timedelta
 
+from gi.repository import GLib
+
 from sugar3.activity import activity
 
 _store = None
 
+_logger = logging.getLogger('places')
+
+# How a visit happened
+TRANSITION_LINK = 0
+TRANSITION_REDIRECT = 1
+
 
 class Place(object):
-    def __init__(self, uri=''):
+    __slots__ = ('uri', 'title', 'bookmark', 'gecko_flags', 'visits',
+                 'last_visit')
+
+    def __init__(self, uri='', title='', bookmark=False, gecko_flags=0,
+                 visits=0, last_visit=None):
+        self.uri = uri
+        self.title = title
+        self.bookmark = bookmark
+        self.gecko_flags = gecko_flags
+        self.visits = visits
+        self.last_visit = last_visit
+
+
+def _get_site(uri):
+    ''' Return the host of the uri and the uri of its root page '''
+    try:
+        parts = urlsplit(uri)
+        host = parts.hostname
+        port = parts.port
+    except ValueError:
+        return None, None
+    if not host:
+        return None, None
+
+    # Without the user info, which must not be shown
+    scheme = parts.scheme.lower()
+    netloc = '[%s]' % host if ':' in host else host
+    if port is not None and port != _DEFAULT_PORTS.get(scheme):
+        netloc = '%s:%d' % (netloc, port)
+    return host, '%s://%s/' % (scheme, netloc)
+
+
+def _is_root(uri):
+    return urlsplit(uri).path in ('', '/')
+
+
+# The query parameters that only tell where a visit came from.  They
+# are left out of the key of the places, so the visits of a page are
+# counted together whatever link was followed to it.
+TRACKING_PARAMETERS = {
+    'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
+    'gclid', 'dclid', 'fbclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid',
+    '_ga',
+}
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
+
+
+def canonicalize_uri(uri):
+    ''' Return the key of the uri in the history
+
+    The fragment, the TRACKING_PARAMETERS and the default port are
+    removed, the scheme and host are folded to lower case, and the
+    empty path of a host is made /.
+    '''
+    try:
+        parts = urlsplit(uri)
+        port = parts.port
+    except ValueError:
+        return uri
+
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc
+    path = parts.path
+    if netloc:
+        netloc = parts.hostname or ''
+        if ':' in netloc:
+            netloc = '[%s]' % netloc
+        if port is not None and port != _DEFAULT_PORTS.get(scheme):
+            netloc = '%s:%d' % (netloc, port)
+        if '@' in parts.netloc:
+            netloc = '%s@%s' % (parts.netloc.rpartition('@')[0], netloc)
+        path = path or '/'
+
+    query = '&'.join(parameter for parameter in parts.query.split('&')
+                     if parameter.partition('=')[0]
+                     not in TRACKING_PARAMETERS)
+
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def parse_timestamp(value):
+    ''' Return a datetime in naive local time, the one the places
+    store, for a datetime or an ISO 8601 string, or None
+    '''
+    if not value:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+
+def _place_factory(cursor, row):
+    # The columns are selected in the order of Place arguments
+    return Place(*row)
+
+
+class _PendingPlace(object):
+    __slots__ = ('uri', 'visits', 'title')
+
+    def __init__(self, uri):
         self.uri = uri
-        self.title = ''
-        self.bookmark = False
-        self.gecko_flags = 0
-        self.visits = 0
-        self.last_visit = datetime.now()
+        # (timestamp, transition, redirects) of each visit
+        self.visits = []
+        self.title = None
+
+
+class SearchCache(object):
+    ''' The recent search results, keyed by the query text
+
+    A query that extends a cached one is answered by filtering the
+    cached places, if those were all the places matching the shorter
+    query.  hits and misses count how many searches were served from
+    the cache and how many had to run a query.
+    '''
+
+    def __init__(self, size, max_matches):
+        self._size = size
+        self._max_matches = max_matches
+        self._results = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, text):
+        with self._lock:
+            result = self._results.get(text)
+            if result is not None:
+                self._results.move_to_end(text)
+                self.hits += 1
+                return list(result)
+
+            for length in range(len(text) - 1, 0, -1):
+                superset = self._results.get(text[:length])
+                if superset is not None and \
+                        len(superset) < self._max_matches:
+                    result = [place for place in superset
+                              if self._matches(place, text)]
+                    self._add(text, result)
+                    self.hits += 1
+                    return list(result)
+
+            self.misses += 1
+            return None
+
+    def _matches(self, place, text):
+        text = text.lower()
+        return text in place.uri.lower() or text in place.title.lower()
+
+    def get_generation(self):
+        return self._generation
+
+    def add(self, text, result, generation):
+        with self._lock:
+            # Drop the results of a query that ran before a write
+            if generation == self._generation:
+                self._add(text, list(result))
+
+    def _add(self, text, result):
+        self._results[text] = result
+        self._results.move_to_end(text)
+        if len(self._results) > self._size:
+            self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._results.clear()
 
 
 class SqliteStore(object):
     MAX_SEARCH_MATCHES = 20
     EXPIRE_DAYS = 30
 
-    def __init__(self):
-        db_path = os.path.join(activity.get_activity_root(),
-                               'data', 'places.db')
+    # Besides EXPIRE_DAYS, the oldest places are dropped to keep the
+    # history under MAX_PLACES and MAX_DB_SIZE.  This is done in
+    # batches, on idle, some time after the store is opened.
+    MAX_PLACES = 50000
+    MAX_DB_SIZE = 32 * 1024 * 1024  # bytes
+    EXPIRE_DELAY = 10  # seconds
+    EXPIRE_BATCH = 200
+
+    # The trigram tokenizer splits both the URL parts and the titles
+    # into overlapping three character tokens, so a full-text match
+    # gives the same substring semantic as the "like '%text%'" scan.
+    # Queries shorter than a trigram can't use the index.
+    FTS_MIN_QUERY_LENGTH = 3
+    # The matches of a query are sorted by frecency.  Queries shorter
+    # than this can match most of the places, so for them the frecency
+    # index is walked until enough matches are found instead.
+    FTS_SORT_MIN_QUERY_LENGTH = 4
 
-        self._connection = sqlite3.connect(db_path)
+    # Visits and titles are kept in memory and written in a single
+    # transaction, to avoid a commit (and a fsync) on every page load.
+    FLUSH_INTERVAL = 5  # seconds
+    MAX_PENDING_PLACES = 100
+
+    SEARCH_CACHE_SIZE = 32
+
+    # Places imported in each transaction by import_places()
+    IMPORT_BATCH = 10000
+
+    # The frecency of a place grows by VISIT_SCORE on each visit and
+    # halves every FRECENCY_HALF_LIFE days.  The decay is applied to
+    # the whole table at once, at most every FRECENCY_DECAY_INTERVAL,
+    # so the frecencies stored are the ones at the time of the last
+    # decay, see _get_visit_score().
+    VISIT_SCORE = 1.0
+    FRECENCY_HALF_LIFE = 14  # days
+    FRECENCY_DECAY_INTERVAL = timedelta(days=1)
+    FRECENCY_DECAY_CHECK = 60 * 60  # seconds
+
+    # Several Browse instances can share the database.  With WAL the
+    # readers don't wait for the writers, and a writer waits up to
+    # BUSY_TIMEOUT for the other writers.
+    BUSY_TIMEOUT = 5  # seconds
+    CACHE_SIZE = 2048  # KiB, for each connection
+
+    # The version of the schema is kept in the user_version of the
+    # database.  The migrations that go through all the places do it
+    # MIGRATION_BATCH places at a time, on idle, and resume from the
+    # last batch done if Browse is closed meanwhile.  Until they are
+    # done, the visits and titles stay in memory, searches don't use
+    # the full-text index and the visits can't be read back.  close()
+    # and the methods that rewrite or go through the whole history,
+    # meant for tools like historyio, finish them first.
+    MIGRATION_BATCH = 5000
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = os.path.join(activity.get_activity_root(),
+                                   'data', 'places.db')
+        self._db_path = db_path
+
+        # Writes go through this connection, searches through
+        # self._reader and the connection of the search worker.
+        self._connection = self._connect()
+        self._connection.create_function('frecency_decay', 1,
+                                         self._frecency_decay)
         cursor = self._connection.cursor()
 
+        self._pending = {}
+        self._flush_sid = None
+        self._search_worker = None
+        self.search_cache = SearchCache(self.SEARCH_CACHE_SIZE,
+                                        self.MAX_SEARCH_MATCHES)
+
         cursor.execute('select * from sqlite_master where name == "places"')
         if cursor.fetchone() is None:
             # Create table to store the visited places.  Note that
@@ -58,92 +305,1165 @@ class SqliteStore(object):
                                 last_visit  timestamp
                               );
                            """)
+
+        self._create_meta_table(cursor)
+
+        # The migration to each schema version, in order
+        self._migrations = [
+            self._remove_null_places,
+            self._create_uri_index,
+            self._create_fts_index,
+            self._add_frecency,
+            self._create_last_visit_index,
+            self._create_visits_tables,
+            self._create_hosts_table,
+            self._add_uri_key,
+        ]
+        self._migrating = True
+        self._fts = False
+        self._expire_excess = None
+        self._full_vacuum_needed = False
+
+        self._reader = self._connect()
+
+        cursor.execute('select max(rowid) from places')
+        if (cursor.fetchone()[0] or 0) <= self.MIGRATION_BATCH:
+            self._complete_migrations()
         else:
-            self._cleanup()
+            GLib.idle_add(self.__migrate_cb, priority=GLib.PRIORITY_LOW)
 
-    def search(self, text):
+    def _connect(self):
+        connection = sqlite3.connect(self._db_path,
+                                     timeout=self.BUSY_TIMEOUT)
+        # Switching to WAL writes the header of a new database, so
+        # auto_vacuum has to be set first.  It doesn't change the
+        # existing databases.
+        connection.execute('pragma auto_vacuum = incremental')
+        connection.execute('pragma journal_mode = wal')
+        # In WAL mode this keeps the database consistent, without a
+        # fsync on every commit
+        connection.execute('pragma synchronous = normal')
+        connection.execute('pragma cache_size = -%d' % self.CACHE_SIZE)
+        return connection
+
+    def _has_table(self, cursor, name):
+        cursor.execute('select * from sqlite_master where name == ?',
+                       (name,))
+        return cursor.fetchone() is not None
+
+    def __migrate_cb(self):
+        if not self._migrating:
+            # The migrations were completed meanwhile
+            return False
+
+        try:
+            if self._migrate_step():
+                return True
+        except sqlite3.Error as e:
+            _logger.warning('Could not migrate history: %s', e)
+            GLib.timeout_add_seconds(self.FLUSH_INTERVAL,
+                                     self.__start_migrate_cb,
+                                     priority=GLib.PRIORITY_LOW)
+            return False
+
+        self._finish_migrations()
+        return False
+
+    def __start_migrate_cb(self):
+        GLib.idle_add(self.__migrate_cb, priority=GLib.PRIORITY_LOW)
+        return False
+
+    def _complete_migrations(self):
+        ''' Run the migrations that are left, without waiting for idle '''
+        if not self._migrating:
+            return
+
+        while self._migrate_step():
+            pass
+        self._finish_migrations()
+
+    def _migrate_step(self):
+        ''' Run the next batch of the first pending migration
+
+        Return True if there are more batches to run.
+        '''
         cursor = self._connection.cursor()
 
         try:
-            text = '%' + text + '%'
-            cursor.execute('select uri, title, bookmark, gecko_flags, '
-                           'visits, last_visit from places '
-                           'where uri like ? or title like ? '
-                           'order by visits desc limit 0, ?',
-                           (text, text, self.MAX_SEARCH_MATCHES))
+            # Other instances of Browse could be migrating the same
+            # database, so the version is read with the write lock.
+            cursor.execute('begin immediate')
+            cursor.execute('pragma user_version')
+            version, = cursor.fetchone()
+            if version >= len(self._migrations):
+                self._connection.rollback()
+                return False
 
-            result = [self._place_from_row(row) for row in cursor]
+            migration = self._migrations[version]
+            start = time.perf_counter()
+            progress = migration(cursor,
+                                 self._get_meta('migration_progress', 0))
+            if progress is None:
+                cursor.execute('delete from places_meta where key = ?',
+                               ('migration_progress',))
+                cursor.execute('pragma user_version = %d' % (version + 1))
+            else:
+                self._set_meta(cursor, 'migration_progress', progress)
+            self._connection.commit()
+        except Exception:
+            self._connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        duration = time.perf_counter() - start
+        if progress is None:
+            _logger.info('History migrated to version %d (%s) in %.3f s',
+                         version + 1, migration.__name__, duration)
+        else:
+            _logger.info('History migration to version %d (%s): '
+                         'place %d done in %.3f s', version + 1,
+                         migration.__name__, progress, duration)
+        return version + 1 < len(self._migrations) or progress is not None
+
+    def _migrate_batch(self, cursor, progress, migrate):
+        ''' Call migrate(first, last) for the next MIGRATION_BATCH
+        places, the ones with first < rowid <= last.
+
+        Return the progress to resume from, or None after the last
+        batch.
+        '''
+        cursor.execute('select rowid from places where rowid > ? '
+                       'order by rowid limit 1 offset ?',
+                       (progress, self.MIGRATION_BATCH - 1))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute('select max(rowid) from places')
+            migrate(progress, cursor.fetchone()[0] or 0)
+            return None
+
+        migrate(progress, row[0])
+        return row[0]
+
+    def _finish_migrations(self):
+        self._migrating = False
+
+        cursor = self._connection.cursor()
+
+        try:
+            self._fts = self._has_table(cursor, 'places_fts')
+        finally:
+            cursor.close()
+        # The results found while migrating weren't ranked by frecency
+        self.search_cache.clear()
+
+        GLib.idle_add(self.__decay_frecency_cb, False,
+                      priority=GLib.PRIORITY_LOW)
+        # Browse can be left open for days
+        GLib.timeout_add_seconds(self.FRECENCY_DECAY_CHECK,
+                                 self.__decay_frecency_cb, True,
+                                 priority=GLib.PRIORITY_LOW)
+
+        GLib.timeout_add_seconds(self.EXPIRE_DELAY, self.__start_expire_cb,
+                                 priority=GLib.PRIORITY_LOW)
+
+    def _create_last_visit_index(self, cursor, progress):
+        cursor.execute('create index if not exists places_last_visit '
+                       'on places (last_visit)')
+
+    def _create_visits_tables(self, cursor, progress):
+        if self._has_table(cursor, 'visits'):
+            return
+
+        # Every visit of a place, and the number of visits of each
+        # place per day, kept up to date as the visits are recorded.
+        # redirects is the uris that redirected to the place, one per
+        # line, or null.
+        cursor.execute("""create table visits (
+                            place_id    integer not null,
+                            visit_time  timestamp not null,
+                            transition  integer not null,
+                            redirects   text
+                          );
+                       """)
+        cursor.execute('create index visits_time on visits (visit_time)')
+        cursor.execute('create index visits_place on visits (place_id)')
+        cursor.execute("""create table visit_days (
+                            day         text not null,
+                            place_id    integer not null,
+                            visits      integer not null,
+                            primary key (day, place_id)
+                          ) without rowid;
+                       """)
+        cursor.execute('create index visit_days_top '
+                       'on visit_days (day, visits desc)')
+        cursor.execute('create index visit_days_place '
+                       'on visit_days (place_id)')
+        cursor.execute("""create trigger places_visits_delete
+                            after delete on places begin
+                              delete from visits where place_id = old.rowid;
+                              delete from visit_days
+                              where place_id = old.rowid;
+                            end;
+                       """)
+
+    def _create_hosts_table(self, cursor, progress):
+        if progress == 0:
+            if self._has_table(cursor, 'hosts'):
+                return None
+
+            # The visits of each host, for the top sites page.  The
+            # title is the one of the root page of the host, if it
+            # was visited.
+            cursor.execute("""create table hosts (
+                                host        text primary key,
+                                uri         text not null,
+                                title       text not null,
+                                visits      integer not null,
+                                last_visit  timestamp
+                              );
+                           """)
+            cursor.execute('create index hosts_top on hosts (visits desc)')
+
+        def migrate(first, last):
+            cursor.execute('select uri, title, visits, last_visit '
+                           'from places where rowid > ? and rowid <= ?',
+                           (first, last))
+            self._add_hosts(cursor, cursor.fetchall())
+
+        return self._migrate_batch(cursor, progress, migrate)
+
+    def _add_hosts(self, cursor, places):
+        ''' Add places, as (uri, title, visits, last_visit), to the
+        visits of their hosts
+        '''
+        hosts = {}
+        for uri, title, visits, last_visit in places:
+            host, root_uri = _get_site(uri)
+            if host is None:
+                continue
+            if host not in hosts:
+                hosts[host] = [host, root_uri, '', 0, last_visit, False]
+            aggregate = hosts[host]
+            aggregate[3] += visits or 0
+            if last_visit is not None and \
+                    (aggregate[4] is None or last_visit > aggregate[4]):
+                aggregate[4] = last_visit
+            if title and (not aggregate[2] or _is_root(uri)):
+                aggregate[2] = title
+                aggregate[5] = aggregate[5] or _is_root(uri)
+
+        cursor.executemany("insert into hosts (host, uri, title, "
+                           "visits, last_visit) values (?, ?, ?, ?, ?) "
+                           "on conflict (host) do update set "
+                           "visits = visits + excluded.visits, "
+                           "last_visit = coalesce(max(last_visit, "
+                           "excluded.last_visit), last_visit, "
+                           "excluded.last_visit), "
+                           "title = case when ? or title = '' "
+                           "then excluded.title else title end",
+                           hosts.values())
+
+    def get_top_hosts(self, limit):
+        ''' Return the most visited hosts, as (uri, title, host) '''
+        if self._migrating:
+            # The hosts table could be incomplete
+            return []
+
+        cursor = self._reader.cursor()
+
+        try:
+            cursor.execute('select uri, title, host from hosts '
+                           'order by visits desc limit ?', (limit,))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _create_meta_table(self, cursor):
+        cursor.execute('create table if not exists places_meta ('
+                       'key text primary key, value)')
+
+    def _get_meta(self, key, default=None):
+        cursor = self._connection.cursor()
+
+        try:
+            cursor.execute('select value from places_meta where key=?',
+                           (key,))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+
+        if row is None:
+            return default
+        return row[0]
+
+    def _set_meta(self, cursor, key, value):
+        cursor.execute('insert or replace into places_meta (key, value) '
+                       'values (?, ?)', (key, value))
+
+    def _add_frecency(self, cursor, progress):
+        if progress == 0:
+            cursor.execute('pragma table_info(places)')
+            if 'frecency' in [row[1] for row in cursor.fetchall()]:
+                return None
+
+            cursor.execute('alter table places add column '
+                           'frecency real not null default 0')
+
+        # Give the places from previous versions the score they would
+        # have if all their visits happened on the last one.
+        def migrate(first, last):
+            cursor.execute("update places set frecency = "
+                           "coalesce(visits, 0) * ? * frecency_decay("
+                           "julianday('now', 'localtime') - "
+                           "julianday(last_visit)) "
+                           "where rowid > ? and rowid <= ?",
+                           (self.VISIT_SCORE, first, last))
+
+        progress = self._migrate_batch(cursor, progress, migrate)
+        if progress is None:
+            cursor.execute('create index places_frecency '
+                           'on places (frecency desc)')
+            self._set_meta(cursor, 'frecency_decayed_at',
+                           datetime.now().timestamp())
+        return progress
+
+    def _get_frecency_decayed_at(self):
+        timestamp = self._get_meta('frecency_decayed_at')
+        if timestamp is None:
+            return datetime.now()
+        return datetime.fromtimestamp(timestamp)
+
+    def _frecency_decay(self, days):
+        if days is None or days < 0:
+            return 1.0
+        return 0.5 ** (days / self.FRECENCY_HALF_LIFE)
+
+    def _get_visit_score(self, timestamp, decayed_at):
+        ''' Return the score of a visit, at the time of the last decay
+
+        The next decay scales it by the time elapsed since that one,
+        which gives the visit its score at the time of the decay.
+        '''
+        days = (decayed_at - timestamp).total_seconds() / (24 * 60 * 60)
+        return self.VISIT_SCORE * 0.5 ** (days / self.FRECENCY_HALF_LIFE)
+
+    def __decay_frecency_cb(self, repeat):
+        self._decay_frecency()
+        return repeat
+
+    def _decay_frecency(self):
+        ''' Decay the frecencies, if the last decay is older than
+        FRECENCY_DECAY_INTERVAL
+        '''
+        cursor = self._connection.cursor()
+
+        try:
+            # Another instance of Browse could be decaying them too
+            cursor.execute('begin immediate')
+            now = datetime.now()
+            decayed_at = self._get_frecency_decayed_at()
+            if now - decayed_at <= self.FRECENCY_DECAY_INTERVAL:
+                self._connection.rollback()
+                return
+
+            days = (now - decayed_at).total_seconds() / (24 * 60 * 60)
+            cursor.execute('update places set frecency = frecency * ? '
+                           'where frecency > 0',
+                           (self._frecency_decay(days),))
+            self._set_meta(cursor, 'frecency_decayed_at', now.timestamp())
+            self._connection.commit()
+        except sqlite3.Error as e:
+            # Try again on the next check
+            self._connection.rollback()
+            _logger.warning('Could not decay the history frecency: %s', e)
+            return
         finally:
             cursor.close()
+        self.search_cache.clear()
 
+    def _remove_null_places(self, cursor, progress):
+        # Previous versions of Browse were allowing to store None for
+        # the uri and title in the places database.  See ticket #3400 .
+        def migrate(first, last):
+            cursor.execute('delete from places where uri is null '
+                           'and rowid > ? and rowid <= ?', (first, last))
+            cursor.execute("update places set title = '' "
+                           "where title is null and rowid > ? "
+                           "and rowid <= ?", (first, last))
+
+        return self._migrate_batch(cursor, progress, migrate)
+
+    def _create_uri_index(self, cursor, progress):
+        if self._has_table(cursor, 'places_uri'):
+            return
+
+        # Previous versions of Browse could store the same uri more
+        # than once; merge those rows into the one visited last.
+        # The temporary tables are keyed, so that each place is merged
+        # with a lookup instead of a scan of all the duplicates.
+        cursor.execute('create temp table places_dups ('
+                       'id integer primary key, uri text unique, '
+                       'visits integer, last_visit timestamp)')
+        # With max(), SQLite takes the rowid of the row visited last
+        cursor.execute('insert into places_dups '
+                       'select rowid, uri, sum(visits), '
+                       'max(last_visit) from places '
+                       'group by uri having count(*) > 1')
+        cursor.execute('update places set '
+                       'visits = (select visits from places_dups '
+                       'where id = places.rowid), '
+                       'last_visit = (select last_visit from places_dups '
+                       'where id = places.rowid) '
+                       'where rowid in (select id from places_dups)')
+        cursor.execute('delete from places where rowid in '
+                       '(select places.rowid from places_dups '
+                       'join places on places.uri = places_dups.uri '
+                       'where places.rowid != places_dups.id)')
+        cursor.execute('drop table places_dups')
+
+        cursor.execute('create unique index places_uri on places (uri)')
+
+    def _add_uri_key(self, cursor, progress):
+        if progress == 0:
+            cursor.execute('pragma table_info(places)')
+            if 'key' in [row[1] for row in cursor.fetchall()]:
+                return None
+
+            # The places are looked up by the canonical form of their
+            # uri, see canonicalize_uri()
+            cursor.execute('alter table places add column key text')
+
+        def migrate(first, last):
+            cursor.execute('select rowid, uri from places '
+                           'where rowid > ? and rowid <= ?', (first, last))
+            cursor.executemany('update places set key=? where rowid=?',
+                               [(canonicalize_uri(uri), rowid)
+                                for rowid, uri in cursor.fetchall()])
+
+        progress = self._migrate_batch(cursor, progress, migrate)
+        if progress is not None:
+            return progress
+
+        # Merge the places with the same key into the one visited last,
+        # with the visits of all of them.
+        # The temporary tables are keyed, so that each place is merged
+        # with lookups instead of scans of all the duplicates.
+        cursor.execute('create temp table places_dups ('
+                       'id integer primary key, key text unique, '
+                       'visits integer, last_visit timestamp, '
+                       'frecency real)')
+        # With max(), SQLite takes the rowid of the row visited last
+        cursor.execute('insert into places_dups '
+                       'select rowid, key, sum(visits), '
+                       'max(last_visit), sum(frecency) from places '
+                       'group by key having count(*) > 1')
+        cursor.execute('create temp table places_merged ('
+                       'old_id integer primary key, new_id integer)')
+        cursor.execute('insert into places_merged '
+                       'select places.rowid, places_dups.id from places_dups '
+                       'join places on places.key = places_dups.key '
+                       'where places.rowid != places_dups.id')
+        cursor.execute('create index temp.places_merged_new '
+                       'on places_merged (new_id)')
+        cursor.execute("update places set "
+                       "visits = (select visits from places_dups "
+                       "where id = places.rowid), "
+                       "last_visit = (select last_visit from places_dups "
+                       "where id = places.rowid), "
+                       "frecency = (select frecency from places_dups "
+                       "where id = places.rowid), "
+                       "title = coalesce(nullif(title, ''), "
+                       "(select max(merged.title) from places as merged "
+                       "join places_merged on merged.rowid = old_id "
+                       "where new_id = places.rowid), '') "
+                       "where rowid in (select id from places_dups)")
+        cursor.execute('update visits set place_id = '
+                       '(select new_id from places_merged '
+                       'where old_id = visits.place_id) '
+                       'where place_id in (select old_id from places_merged)')
+        cursor.execute('insert into visit_days (day, place_id, visits) '
+                       'select day, new_id, visits from visit_days '
+                       'join places_merged on place_id = old_id where true '
+                       'on conflict (day, place_id) do update set '
+                       'visits = visits + excluded.visits')
+        cursor.execute('delete from places where rowid in '
+                       '(select old_id from places_merged)')
+        cursor.execute('drop table places_merged')
+        cursor.execute('drop table places_dups')
+
+        cursor.execute('drop index if exists places_uri')
+        cursor.execute('create unique index places_key on places (key)')
+        return None
+
+    def _create_fts_index(self, cursor, progress):
+        if progress == 0:
+            if self._has_table(cursor, 'places_fts'):
+                return None
+
+            try:
+                cursor.execute("""create virtual table places_fts
+                                    using fts5 (
+                                    uri, title,
+                                    content='places', content_rowid='rowid',
+                                    tokenize='trigram'
+                                  );
+                               """)
+            except sqlite3.OperationalError as e:
+                # SQLite built without FTS5 or older than 3.34
+                _logger.warning('Full-text index not available: %s', e)
+                return None
+
+        # Index the places stored by previous versions of Browse
+        def migrate(first, last):
+            cursor.execute('insert into places_fts (rowid, uri, title) '
+                           'select rowid, uri, title from places '
+                           'where rowid > ? and rowid <= ?', (first, last))
+
+        progress = self._migrate_batch(cursor, progress, migrate)
+        if progress is not None:
+            return progress
+
+        # Keep the index in sync with every write to the places table
+        cursor.execute("""create trigger places_fts_insert
+                            after insert on places begin
+                              insert into places_fts (rowid, uri, title)
+                              values (new.rowid, new.uri, new.title);
+                            end;
+                       """)
+        cursor.execute("""create trigger places_fts_delete
+                            after delete on places begin
+                              insert into places_fts
+                              (places_fts, rowid, uri, title)
+                              values ('delete', old.rowid, old.uri, old.title);
+                            end;
+                       """)
+        cursor.execute("""create trigger places_fts_update
+                            after update of uri, title on places begin
+                              insert into places_fts
+                              (places_fts, rowid, uri, title)
+                              values ('delete', old.rowid, old.uri, old.title);
+                              insert into places_fts (rowid, uri, title)
+                              values (new.rowid, new.uri, new.title);
+                            end;
+                       """)
+        return None
+
+    def search(self, text):
+        return self._search(self._reader, text)
+
+    def search_async(self, text, callback):
+        ''' Search the places in a worker thread
+
+        callback(text, places) is called from the main loop with the
+        result.  A newer search cancels the one that is still pending
+        or running, and its callback is never called.
+        '''
+        if self._search_worker is None:
+            self._search_worker = _SearchWorker(self)
+            self._search_worker.start()
+        self._search_worker.request(text, callback)
+
+    def cancel_search(self):
+        if self._search_worker is not None:
+            self._search_worker.cancel()
+
+    def _search(self, connection, text):
+        result = self.search_cache.lookup(text)
+        if result is not None:
+            return result
+
+        generation = self.search_cache.get_generation()
+        cursor = connection.cursor()
+        cursor.row_factory = _place_factory
+
+        try:
+            if self._fts and len(text) >= self.FTS_MIN_QUERY_LENGTH:
+                # Quote the text so it is matched as a single phrase
+                query = '"%s"' % text.replace('"', '""')
+                # The unary + keeps SQLite from looking up the matches
+                # by rowid, and makes it walk the frecency index.
+                if len(text) < self.FTS_SORT_MIN_QUERY_LENGTH:
+                    rowid = '+rowid'
+                else:
+                    rowid = 'rowid'
+                cursor.execute('select uri, title, bookmark, gecko_flags, '
+                               'visits, last_visit from places '
+                               'where %s in (select rowid from places_fts '
+                               'where places_fts match ?) '
+                               'order by frecency desc limit 0, ?' % rowid,
+                               (query, self.MAX_SEARCH_MATCHES))
+            else:
+                # The frecency isn't there until the schema is migrated,
+                # and neither is the removal of the null uris and titles
+                # stored by previous versions.
+                order = 'last_visit' if self._migrating else 'frecency'
+                pattern = '%' + text + '%'
+                cursor.execute("select uri, coalesce(title, ''), bookmark, "
+                               'gecko_flags, visits, last_visit from places '
+                               'where uri is not null '
+                               'and (uri like ? or title like ?) '
+                               'order by %s desc limit 0, ?' % order,
+                               (pattern, pattern, self.MAX_SEARCH_MATCHES))
+
+            result = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        self.search_cache.add(text, result, generation)
         return result
 
     def add_place(self, place):
+        self._complete_migrations()
         cursor = self._connection.cursor()
 
         try:
-            cursor.execute('insert into places (uri, title, bookmark, '
-                           'gecko_flags, visits, last_visit) '
-                           'values (?, ?, ?, ?, ?, ?)',
-                           (place.uri, place.title, place.bookmark,
-                            place.gecko_flags, place.visits, place.last_visit))
+            cursor.execute('insert into places (uri, key, title, '
+                           'bookmark, gecko_flags, visits, last_visit) '
+                           'values (?, ?, ?, ?, ?, ?, ?)',
+                           (place.uri, canonicalize_uri(place.uri),
+                            place.title, place.bookmark,
+                            place.gecko_flags, place.visits,
+                            place.last_visit or datetime.now()))
             self._connection.commit()
         finally:
             cursor.close()
+        self.search_cache.clear()
 
     def lookup_place(self, uri):
+        self.flush()
         cursor = self._connection.cursor()
+        cursor.row_factory = _place_factory
 
         try:
-            cursor.execute('select uri, title, bookmark, gecko_flags,visits, '
-                           'last_visit from places where uri=?', (uri,))
-
-            row = cursor.fetchone()
-            if row:
-                return self._place_from_row(row)
+            if self._migrating:
+                # The places could have no key yet
+                cursor.execute('select uri, title, bookmark, gecko_flags, '
+                               'visits, last_visit from places where uri=?',
+                               (uri,))
             else:
-                return None
+                cursor.execute('select uri, title, bookmark, gecko_flags, '
+                               'visits, last_visit from places where key=?',
+                               (canonicalize_uri(uri),))
+            return cursor.fetchone()
         finally:
             cursor.close()
 
     def update_place(self, place):
+        self._complete_migrations()
         cursor = self._connection.cursor()
 
         try:
             cursor.execute('update places set title=?, gecko_flags=?, '
-                           'visits=?, last_visit=?, bookmark=? where uri=?',
+                           'visits=?, last_visit=?, bookmark=? where key=?',
                            (place.title, place.gecko_flags, place.visits,
-                            place.last_visit, place.bookmark, place.uri))
+                            place.last_visit, place.bookmark,
+                            canonicalize_uri(place.uri)))
             self._connection.commit()
         finally:
             cursor.close()
+        self.search_cache.clear()
 
-    def _place_from_row(self, row):
-        place = Place()
+    def iter_places(self, batch_size=1000):
+        ''' Yield all the places, without loading them all in memory '''
+        self._complete_migrations()
+        self.flush()
+        # A connection of its own reads a consistent snapshot
+        connection = self._connect()
+        cursor = connection.cursor()
+        cursor.row_factory = _place_factory
 
-        # Return uri and title as empty strings instead of None.
-        # Previous versions of Browse were allowing to store None for
-        # those fields in the places database.  See ticket #3400 .
-        if row[0] is None:
-            row = tuple([''] + list(row[1:]))
-        if row[1] is None:
-            row = tuple([row[0], ''] + list(row[2:]))
+        try:
+            cursor.execute('select uri, title, bookmark, gecko_flags, '
+                           'visits, last_visit from places order by rowid')
+            while True:
+                places = cursor.fetchmany(batch_size)
+                if not places:
+                    break
+                yield from places
+        finally:
+            cursor.close()
+            connection.close()
+
+    def import_places(self, places):
+        ''' Merge places into the history, IMPORT_BATCH per transaction
+
+        places can be any iterable, it is consumed as it is written.
+        A place already in the history keeps the largest visit count
+        and last visit of the two, so restoring the same backup again
+        changes nothing.  Return the number of places imported.
+        '''
+        self._complete_migrations()
+        self.flush()
+        now = datetime.now()
+        decayed_at = self._get_frecency_decayed_at()
+        count = 0
+
+        def rows(batch):
+            for place in batch:
+                # The places can come from iter_places() or from a file
+                last_visit = min(parse_timestamp(place.last_visit) or now,
+                                 now)
+                try:
+                    visits = max(0, int(place.visits))
+                except (TypeError, ValueError):
+                    visits = 1
+                score = self._get_visit_score(last_visit, decayed_at)
+                yield (place.uri, canonicalize_uri(place.uri),
+                       place.title or '', bool(place.bookmark),
+                       place.gecko_flags or 0, visits, last_visit,
+                       visits * score)
+
+        def added_visits(cursor, batch):
+            # The visits that the batch adds to the history, for the
+            # hosts of the places
+            known = {}
+            for row in batch:
+                key, visits = row[1], row[5]
+                if key not in known:
+                    cursor.execute('select visits from places '
+                                   'where key = ?', (key,))
+                    known_row = cursor.fetchone()
+                    known[key] = (known_row[0] or 0) if known_row else 0
+                yield (row[0], row[2], max(0, visits - known[key]), row[6])
+                known[key] = max(known[key], visits)
+
+        cursor = self._connection.cursor()
+
+        try:
+            iterator = iter(places)
+            while True:
+                batch = list(itertools.islice(iterator, self.IMPORT_BATCH))
+                if not batch:
+                    break
+                batch = list(rows(batch))
+                # The top sites page reads the hosts
+                self._add_hosts(cursor, list(added_visits(cursor, batch)))
+                cursor.executemany('insert into places (uri, key, '
+                                   'title, bookmark, gecko_flags, visits, '
+                                   'last_visit, frecency) '
+                                   'values (?, ?, ?, ?, ?, ?, ?, ?) '
+                                   'on conflict (key) do update set '
+                                   "title = coalesce(nullif(title, ''), "
+                                   'excluded.title), '
+                                   'visits = max(visits, excluded.visits), '
+                                   'last_visit = max(last_visit, '
+                                   'excluded.last_visit), '
+                                   'frecency = max(frecency, '
+                                   'excluded.frecency)',
+                                   batch)
+                self._connection.commit()
+                count += len(batch)
+        except Exception:
+            self._connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            self.search_cache.clear()
+
+        return count
+
+    def record_visit(self, uri, last_visit, transition=TRANSITION_LINK,
+                     redirects=()):
+        ''' Record a visit of the uri, redirects are the uris that
+        redirected to it, in order
+        '''
+        pending = self._get_pending(uri)
+        pending.visits.append((last_visit, transition, tuple(redirects)))
+
+    def set_place_title(self, uri, title):
+        pending = self._get_pending(uri)
+        pending.title = title
+
+    def _get_pending(self, uri):
+        key = canonicalize_uri(uri)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _PendingPlace(uri)
+
+            if len(self._pending) >= self.MAX_PENDING_PLACES:
+                self._schedule_flush(0)
+            elif self._flush_sid is None:
+                self._schedule_flush(self.FLUSH_INTERVAL)
+        return pending
+
+    def _schedule_flush(self, interval):
+        if self._flush_sid is not None:
+            GLib.source_remove(self._flush_sid)
+        self._flush_sid = GLib.timeout_add_seconds(
+            interval, self.__flush_cb, priority=GLib.PRIORITY_LOW)
+
+    def __flush_cb(self):
+        self._flush_sid = None
+        self.flush()
+        return False
+
+    def flush(self):
+        if self._flush_sid is not None:
+            GLib.source_remove(self._flush_sid)
+            self._flush_sid = None
+
+        if not self._pending:
+            return
+
+        if self._migrating:
+            # Keep the writes in memory until the schema is migrated
+            self._schedule_flush(self.FLUSH_INTERVAL)
+            return
+
+        decayed_at = self._get_frecency_decayed_at()
+        places = [(pending.uri, key, '', False, 0, len(pending.visits),
+                   max(pending.visits)[0],
+                   sum(self._get_visit_score(visit[0], decayed_at)
+                       for visit in pending.visits))
+                  for key, pending in self._pending.items()
+                  if pending.visits]
+        titles = [(pending.title, key)
+                  for key, pending in self._pending.items()
+                  if pending.title is not None]
+
+        cursor = self._connection.cursor()
+
+        try:
+            cursor.executemany('insert into places (uri, key, title, '
+                               'bookmark, gecko_flags, visits, last_visit, '
+                               'frecency) values (?, ?, ?, ?, ?, ?, ?, ?) '
+                               'on conflict (key) do update set '
+                               'visits = visits + excluded.visits, '
+                               'last_visit = excluded.last_visit, '
+                               'frecency = frecency + excluded.frecency',
+                               places)
+            cursor.executemany('update places set title=? where key=?',
+                               titles)
+            self._insert_visits(cursor)
+            self._update_hosts(cursor)
+            self._connection.commit()
+        except sqlite3.Error as e:
+            # Keep the pending writes and try again later
+            self._connection.rollback()
+            _logger.warning('Could not write history: %s', e)
+            self._schedule_flush(self.FLUSH_INTERVAL)
+            return
+        finally:
+            cursor.close()
+
+        self._pending = {}
+        self.search_cache.clear()
+
+    def _insert_visits(self, cursor):
+        visits = []
+        for key, pending in self._pending.items():
+            if not pending.visits:
+                continue
+
+            cursor.execute('select rowid from places where key=?', (key,))
+            place_id, = cursor.fetchone()
+            for timestamp, transition, redirects in pending.visits:
+                visits.append((place_id, timestamp, transition,
+                               '\n'.join(redirects) or None))
+
+        cursor.executemany('insert into visits (place_id, visit_time, '
+                           'transition, redirects) values (?, ?, ?, ?)',
+                           visits)
+        cursor.executemany('insert into visit_days (day, place_id, visits) '
+                           'values (?, ?, 1) '
+                           'on conflict (day, place_id) do update set '
+                           'visits = visits + 1',
+                           [(timestamp.date().isoformat(), place_id)
+                            for place_id, timestamp, transition_, redirects_
+                            in visits])
+
+    def _update_hosts(self, cursor):
+        hosts = []
+        host_titles = []
+        for pending in self._pending.values():
+            host, root_uri = _get_site(pending.uri)
+            if host is None:
+                continue
+            if pending.visits:
+                hosts.append((host, root_uri, len(pending.visits),
+                              max(pending.visits)[0]))
+            if pending.title:
+                host_titles.append((pending.title, host,
+                                    _is_root(pending.uri)))
+
+        cursor.executemany("insert into hosts (host, uri, title, visits, "
+                           "last_visit) values (?, ?, '', ?, ?) "
+                           "on conflict (host) do update set "
+                           "uri = excluded.uri, "
+                           "visits = visits + excluded.visits, "
+                           "last_visit = max(last_visit, "
+                           "excluded.last_visit)", hosts)
+        cursor.executemany("update hosts set title = ? where host = ? "
+                           "and (? or title = '')", host_titles)
+
+    def get_visits(self, start, end):
+        ''' Return the visits between the start and end datetimes, in
+        chronological order, as (uri, title, visit_time, transition,
+        redirects)
+        '''
+        if self._migrating:
+            # The visits could be incomplete
+            return []
+
+        self.flush()
+        cursor = self._reader.cursor()
+
+        try:
+            cursor.execute('select places.uri, places.title, '
+                           'visits.visit_time, visits.transition, '
+                           'visits.redirects from visits join places '
+                           'on places.rowid = visits.place_id '
+                           'where visits.visit_time >= ? '
+                           'and visits.visit_time < ? '
+                           'order by visits.visit_time', (start, end))
+            return [(uri, title, visit_time, transition,
+                     redirects.split('\n') if redirects else [])
+                    for uri, title, visit_time, transition, redirects
+                    in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def get_top_places_per_day(self, start, end, limit=10):
+        ''' Return the most visited places of each day from the start
+        date until the end date, included, as a list of
+        (date, [(uri, title, visits), ...]) for the days with visits.
+        '''
+        if self._migrating:
+            # The visits could be incomplete
+            return []
+
+        self.flush()
+        result = []
+        cursor = self._reader.cursor()
+
+        try:
+            day = start
+            while day <= end:
+                cursor.execute('select places.uri, places.title, '
+                               'visit_days.visits from visit_days '
+                               'join places '
+                               'on places.rowid = visit_days.place_id '
+                               'where visit_days.day = ? '
+                               'order by visit_days.visits desc limit ?',
+                               (day.isoformat(), limit))
+                top = cursor.fetchall()
+                if top:
+                    result.append((day, top))
+                day += timedelta(days=1)
+        finally:
+            cursor.close()
 
-        place.uri, place.title, place.bookmark, place.gecko_flags, \
-            place.visits, place.last_visit = row
+        return result
+
+    def __start_expire_cb(self):
+        self._expire_excess = None
+        GLib.idle_add(self.__expire_cb, priority=GLib.PRIORITY_LOW)
+        return False
 
-        return place
+    def __expire_cb(self):
+        try:
+            if self._expire_step():
+                return True
+            self._vacuum()
+        except sqlite3.Error as e:
+            # Another instance of Browse could hold the database
+            self._connection.rollback()
+            _logger.warning('Could not expire history: %s', e)
+            GLib.timeout_add_seconds(self.EXPIRE_DELAY,
+                                     self.__start_expire_cb,
+                                     priority=GLib.PRIORITY_LOW)
+        return False
 
     def _cleanup(self):
+        self._complete_migrations()
+        self._expire_excess = None
+        while self._expire_step():
+            pass
+        self._vacuum()
+        if self._full_vacuum_needed:
+            self._full_vacuum()
+
+    def close(self):
+        ''' Finish the migrations, write the visits and titles that are
+        waiting, and run the full vacuum that was left for when Browse
+        exits
+        '''
+        self._complete_migrations()
+        self.flush()
+        if self._full_vacuum_needed:
+            self._full_vacuum()
+
+    def _expire_step(self):
+        ''' Delete a batch of the oldest places that are expired, or
+        that exceed the size limits of the history.
+
+        Return True if there are more places to delete.
+        '''
         cursor = self._connection.cursor()
 
         try:
+            if self._expire_excess is None:
+                self._expire_excess = self._get_excess(cursor)
+
             date = datetime.now() - timedelta(days=self.EXPIRE_DAYS)
-            cursor.execute('delete from places where last_visit < ?', (date,))
+            cursor.execute('delete from places where rowid in '
+                           '(select rowid from places where last_visit < ? '
+                           'order by last_visit limit ?)',
+                           (date, self.EXPIRE_BATCH))
+            deleted = cursor.rowcount
+            self._expire_excess = max(0, self._expire_excess - deleted)
+
+            # The places that are kept can have expired visits
+            cursor.execute('delete from visits where rowid in '
+                           '(select rowid from visits where visit_time < ? '
+                           'order by visit_time limit ?)',
+                           (date, self.EXPIRE_BATCH))
+            more_visits = cursor.rowcount == self.EXPIRE_BATCH
+            cursor.execute('delete from visit_days where day < ?',
+                           (date.date().isoformat(),))
+            cursor.execute('delete from hosts where last_visit < ?', (date,))
+
+            if deleted < self.EXPIRE_BATCH and self._expire_excess > 0:
+                batch = min(self.EXPIRE_BATCH - deleted, self._expire_excess)
+                cursor.execute('delete from places where rowid in '
+                               '(select rowid from places '
+                               'order by last_visit limit ?)', (batch,))
+                deleted += cursor.rowcount
+                self._expire_excess = max(
+                    0, self._expire_excess - cursor.rowcount)
+
             self._connection.commit()
         finally:
             cursor.close()
 
+        if deleted:
+            self.search_cache.clear()
+        return deleted == self.EXPIRE_BATCH or more_visits
+
+    def _get_excess(self, cursor):
+        ''' Return how many places exceed MAX_PLACES or MAX_DB_SIZE '''
+        cursor.execute('select count(*) from places')
+        count, = cursor.fetchone()
+
+        cursor.execute('pragma page_size')
+        page_size, = cursor.fetchone()
+        cursor.execute('pragma page_count')
+        page_count, = cursor.fetchone()
+        cursor.execute('pragma freelist_count')
+        freelist_count, = cursor.fetchone()
+        size = (page_count - freelist_count) * page_size
+
+        # The size is estimated once, as the full-text index doesn't
+        # shrink as soon as places are deleted.
+        excess = count - self.MAX_PLACES
+        if size > self.MAX_DB_SIZE:
+            excess = max(excess, int(count * (1 - self.MAX_DB_SIZE / size)))
+        return max(0, excess)
+
+    def _vacuum(self):
+        ''' Give the free pages back to the file system '''
+        cursor = self._connection.cursor()
+
+        try:
+            cursor.execute('pragma auto_vacuum')
+            auto_vacuum, = cursor.fetchone()
+            if auto_vacuum == 2:
+                # Each step of the pragma frees a single page, and
+                # only executescript() runs it to completion.
+                cursor.executescript('pragma incremental_vacuum;')
+            else:
+                # Databases of previous versions need a full vacuum,
+                # once, to switch to incremental vacuum.  It rewrites
+                # the whole file, so it is left for close().
+                self._full_vacuum_needed = True
+        finally:
+            cursor.close()
+
+    def _full_vacuum(self):
+        cursor = self._connection.cursor()
+
+        try:
+            # Skip it if another instance of Browse uses the database,
+            # rather than waiting for it.
+            cursor.execute('pragma busy_timeout = 0')
+            cursor.execute('pragma auto_vacuum = incremental')
+            cursor.execute('vacuum')
+            self._full_vacuum_needed = False
+        except sqlite3.OperationalError as e:
+            _logger.info('History not vacuumed: %s', e)
+        finally:
+            cursor.execute('pragma busy_timeout = %d' %
+                           (self.BUSY_TIMEOUT * 1000))
+            cursor.close()
+
+
+class _SearchWorker(threading.Thread):
+    ''' Run the search queries with a read connection of its own '''
+
+    def __init__(self, store):
+        threading.Thread.__init__(self, name='places-search', daemon=True)
+        self._store = store
+        self._connection = None
+        self._condition = threading.Condition()
+        self._request = None
+        self._serial = 0
+        self._running = False
+
+    def request(self, text, callback):
+        with self._condition:
+            self._serial += 1
+            self._request = (self._serial, text, callback)
+            self._interrupt()
+            self._condition.notify()
+
+    def cancel(self):
+        with self._condition:
+            self._serial += 1
+            self._request = None
+            self._interrupt()
+
+    def _interrupt(self):
+        # Abort the query that is running for a stale request
+        if self._running:
+            self._connection.interrupt()
+
+    def run(self):
+        self._connection = self._store._connect()
+
+        while True:
+            with self._condition:
+                while self._request is None:
+                    self._condition.wait()
+                serial, text, callback = self._request
+                self._request = None
+                self._running = True
+
+            try:
+                result = self._store._search(self._connection, text)
+            except sqlite3.OperationalError as e:
+                # Also raised when a stale query is interrupted
+                result = None
+                if serial == self._serial:
+                    _logger.warning('Could not search history: %s', e)
+            except Exception:
+                # Keep serving the next requests
+                result = None
+                _logger.exception('Could not search history')
+
+            with self._condition:
+                self._running = False
+
+            if result is not None:
+                GLib.idle_add(self.__search_done_cb, serial, text, result,
+                              callback)
+
+    def __search_done_cb(self, serial, text, result, callback):
+        # Only the result of the latest request is given back
+        if serial == self._serial:
+            callback(text, result)
+        return False
+
 
 def get_store():
     global _store
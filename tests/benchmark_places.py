@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''Benchmark the places store and the global history on synthetic
+histories, without a display or a Sugar session.
+
+    python3 tests/benchmark_places.py --sizes 10000 100000 \\
+        --output bench.json
+
+The results are written as JSON, so that runs on different commits
+can be compared.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import types
+from datetime import datetime, timedelta
+
+_BUNDLE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_WORDS = ['sugar', 'labs', 'learning', 'python', 'wiki', 'activity',
+          'journal', 'turtle', 'music', 'paint', 'physics', 'maths',
+          'history', 'science', 'reading', 'writing', 'school', 'games',
+          'news', 'video', 'library', 'class', 'teacher', 'project']
+_TLDS = ['org', 'com', 'net', 'edu', 'info']
+
+# Typed one key at a time in the URL bar
+_QUERIES = ['wikipedia', 'sugarlabs', 'http://www.python', 'zzzzzz']
+
+_activity_root = None
+
+
+def _stub_sugar():
+    ''' Let places be imported without Sugar '''
+    def get_activity_root():
+        return _activity_root
+
+    activity_module = types.ModuleType('sugar3.activity.activity')
+    activity_module.get_activity_root = get_activity_root
+    activity_package = types.ModuleType('sugar3.activity')
+    activity_package.activity = activity_module
+    sugar3 = types.ModuleType('sugar3')
+    sugar3.activity = activity_package
+
+    sys.modules['sugar3'] = sugar3
+    sys.modules['sugar3.activity'] = activity_package
+    sys.modules['sugar3.activity.activity'] = activity_module
+
+
+def _make_uri(rand):
+    host = '%s%d.%s' % (rand.choice(_WORDS), rand.randrange(2000),
+                        rand.choice(_TLDS))
+    path = '/'.join(rand.choice(_WORDS)
+                    for i in range(rand.randrange(1, 4)))
+    scheme = rand.choice(['http', 'https'])
+    return '%s://www.%s/%s?id=%d' % (scheme, host, path,
+                                     rand.randrange(1000000))
+
+
+def _make_title(rand):
+    return ' '.join(rand.choice(_WORDS).capitalize()
+                    for i in range(rand.randrange(2, 7)))
+
+
+def _generate_history(db_path, rows, seed):
+    ''' Write a places table like the ones of previous versions '''
+    rand = random.Random(seed)
+    now = datetime.now()
+
+    def places():
+        for i in range(rows):
+            # Some of the places are old enough to expire
+            age = timedelta(seconds=rand.randrange(60 * 24 * 60 * 60))
+            yield (_make_uri(rand), _make_title(rand), False, 0,
+                   rand.randrange(1, 50), now - age)
+
+    connection = sqlite3.connect(db_path)
+    connection.execute('create table places (uri text, title text, '
+                       'bookmark boolean, gecko_flags integer, '
+                       'visits integer, last_visit timestamp)')
+    connection.executemany('insert into places values (?, ?, ?, ?, ?, ?)',
+                           places())
+    connection.commit()
+    connection.close()
+
+
+def _measure(results, rows, operation, durations):
+    results.append({
+        'rows': rows,
+        'operation': operation,
+        'count': len(durations),
+        'total': sum(durations),
+        'mean': statistics.mean(durations),
+        'median': statistics.median(durations),
+        'max': max(durations),
+    })
+    print('%9d %-22s %6d  mean %9.3f ms  max %9.3f ms' % (
+        rows, operation, len(durations),
+        statistics.mean(durations) * 1000, max(durations) * 1000))
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def _run(rows, operations, seed, results):
+    import places
+    import globalhistory
+
+    db_path = os.path.join(_activity_root, 'data', 'places.db')
+    _generate_history(db_path, rows, seed)
+
+    durations = []
+    start = time.perf_counter()
+    store = places.SqliteStore()
+    durations.append(time.perf_counter() - start)
+    _measure(results, rows, 'open', durations)
+    _measure(results, rows, 'migrate', [_timed(store._complete_migrations)])
+
+    places._store = store
+    history = globalhistory.GlobalHistory()
+    rand = random.Random(seed + 1)
+
+    durations = []
+    for query in _QUERIES:
+        for length in range(1, len(query) + 1):
+            store.search_cache.clear()
+            durations.append(_timed(store.search, query[:length]))
+    _measure(results, rows, 'search', durations)
+
+    durations = []
+    for query in _QUERIES:
+        store.search_cache.clear()
+        for length in range(1, len(query) + 1):
+            durations.append(_timed(store.search, query[:length]))
+    _measure(results, rows, 'search (typing)', durations)
+
+    uris = [_make_uri(rand) for i in range(operations)]
+
+    durations = [_timed(history.add_page, uri) for uri in uris]
+    _measure(results, rows, 'add_page', durations)
+    _measure(results, rows, 'flush (visits)', [_timed(store.flush)])
+
+    durations = [_timed(history.set_page_title, uri, _make_title(rand))
+                 for uri in uris]
+    _measure(results, rows, 'set_page_title', durations)
+    _measure(results, rows, 'flush (titles)', [_timed(history.flush)])
+
+    _measure(results, rows, '_cleanup', [_timed(store._cleanup)])
+
+    places._store = None
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=_BUNDLE_PATH,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    global _activity_root
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help='number of places in each synthetic history')
+    parser.add_argument('--operations', type=int, default=1000,
+                        help='number of pages visited and titled')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_output.json',
+                        help='file to write the results to')
+    args = parser.parse_args()
+
+    _stub_sugar()
+    sys.path.insert(0, _BUNDLE_PATH)
+
+    results = []
+    for rows in args.sizes:
+        _activity_root = tempfile.mkdtemp(prefix='browse-bench-')
+        os.mkdir(os.path.join(_activity_root, 'data'))
+        try:
+            _run(rows, args.operations, args.seed, results)
+        finally:
+            shutil.rmtree(_activity_root)
+
+    report = {
+        'commit': _get_commit(),
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
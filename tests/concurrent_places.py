@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''Check that several Browse instances can share the places database,
+each one recording visits and searching at the same time.
+
+    python3 tests/concurrent_places.py --processes 6 --visits 500
+
+Exit with a non-zero status if a visit is lost or a process fails.
+'''
+
+import os
+import sys
+import types
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+_BUNDLE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The places shared by all the processes, the others are their own
+_SHARED_PLACES = 20
+
+
+def _stub_sugar():
+    ''' Let places be imported without Sugar '''
+    activity_module = types.ModuleType('sugar3.activity.activity')
+    activity_module.get_activity_root = None
+    activity_package = types.ModuleType('sugar3.activity')
+    activity_package.activity = activity_module
+    sugar3 = types.ModuleType('sugar3')
+    sugar3.activity = activity_package
+
+    sys.modules['sugar3'] = sugar3
+    sys.modules['sugar3.activity'] = activity_package
+    sys.modules['sugar3.activity.activity'] = activity_module
+
+
+def _make_uri(process, index):
+    if index % 2:
+        return 'http://shared.example.org/%d' % (index % _SHARED_PLACES)
+    return 'http://process%d.example.org/%d' % (process, index)
+
+
+def _work(args):
+    db_path, process, visits = args
+    _stub_sugar()
+    sys.path.insert(0, _BUNDLE_PATH)
+    import places
+
+    store = places.SqliteStore(db_path)
+    for index in range(visits):
+        uri = _make_uri(process, index)
+        store.record_visit(uri, datetime.now())
+        store.set_place_title(uri, 'Page %d of process %d' %
+                              (index, process))
+        if index % 10 == 0:
+            store.flush()
+        store.search('example')
+    store.flush()
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--processes', type=int, default=6)
+    parser.add_argument('--visits', type=int, default=500,
+                        help='number of visits recorded by each process')
+    args = parser.parse_args()
+
+    _stub_sugar()
+    sys.path.insert(0, _BUNDLE_PATH)
+    import places
+
+    directory = tempfile.mkdtemp(prefix='browse-concurrent-')
+    db_path = os.path.join(directory, 'places.db')
+    try:
+        # Create the database before the processes race to do it
+        places.SqliteStore(db_path).close()
+
+        # Each process opens its own connections, as Browse does
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(args.processes) as pool:
+            pool.map(_work, [(db_path, process, args.visits)
+                             for process in range(args.processes)])
+
+        connection = sqlite3.connect(db_path)
+        visits, = connection.execute(
+            'select sum(visits) from places').fetchone()
+        rows, = connection.execute('select count(*) from visits').fetchone()
+        connection.close()
+    finally:
+        shutil.rmtree(directory)
+
+    expected = args.processes * args.visits
+    print('%d processes, %d visits expected, %d counted, %d recorded' % (
+        args.processes, expected, visits, rows))
+    if visits != expected or rows != expected:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
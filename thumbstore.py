@@ -0,0 +1,106 @@
+# Copyright (C) 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''Content-addressed store of the thumbnails of the shared links.
+
+Each thumbnail is kept once, in a file named after the sha1 of its
+data, under the data directory of the activity.  The links only keep
+that digest, so the journal entries stay small.
+
+The store is shared by all the journal entries, so a thumbnail can't
+be deleted when a link is removed from one of them.  Instead, the
+store is kept under MAX_THUMBS by deleting the thumbnails that were
+used least recently.
+'''
+
+import os
+import re
+import tempfile
+from hashlib import sha1
+
+from sugar3.activity import activity
+
+_DIGEST_RE = re.compile('[0-9a-f]{40}')
+
+MAX_THUMBS = 2000
+
+
+def _get_dir():
+    return os.path.join(activity.get_activity_root(), 'data', 'thumbs')
+
+
+def put(data):
+    ''' Store the thumbnail data and return its digest '''
+    digest = sha1(data).hexdigest()
+    path = os.path.join(_get_dir(), digest)
+    if os.path.exists(path):
+        _touch(path)
+        return digest
+
+    os.makedirs(_get_dir(), exist_ok=True)
+    # Other instances of Browse could write the same thumbnail
+    fd, temp_path = tempfile.mkstemp(dir=_get_dir())
+    with os.fdopen(fd, 'wb') as temp_file:
+        temp_file.write(data)
+    os.replace(temp_path, path)
+    prune()
+    return digest
+
+
+def get(digest):
+    ''' Return the thumbnail data, or None if it isn't in the store '''
+    # The digests come from the buddies too
+    if not digest or not _DIGEST_RE.fullmatch(digest):
+        return None
+
+    path = os.path.join(_get_dir(), digest)
+    try:
+        with open(path, 'rb') as thumb_file:
+            data = thumb_file.read()
+    except OSError:
+        return None
+    _touch(path)
+    return data
+
+
+def prune(max_thumbs=None):
+    ''' Delete the least recently used thumbnails, to keep at most
+    max_thumbs of them, MAX_THUMBS by default
+    '''
+    if max_thumbs is None:
+        max_thumbs = MAX_THUMBS
+    try:
+        entries = [entry for entry in os.scandir(_get_dir())
+                   if _DIGEST_RE.fullmatch(entry.name)]
+        if len(entries) <= max_thumbs:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+    except OSError:
+        return
+
+    for entry in entries[:len(entries) - max_thumbs]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def _touch(path):
+    # The modification time tells when the thumbnail was last used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
@@ -0,0 +1,116 @@
+# Copyright (C) 2026 Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from gettext import gettext as _
+from html import escape
+
+from gi.repository import GLib
+from gi.repository import Gio
+
+import places
+
+SCHEME = 'browse'
+URI = SCHEME + ':top-sites'
+
+MAX_SITES = 12
+
+_PAGE = '''<!DOCTYPE html>
+<html>
+    <head>
+        <title>%(title)s</title>
+        <meta http-equiv="Content-type" content="text/html; charset=utf-8"/>
+        <style type="text/css">
+            html {
+                font-family: Helvetica, Arial, sans-serif;
+                margin: 24px;
+            }
+            .sites {
+                display: flex;
+                flex-wrap: wrap;
+                justify-content: center;
+            }
+            .site {
+                width: 200px;
+                margin: 8px;
+                padding: 16px;
+                border-radius: 15px;
+                background-color: rgba(211, 211, 211, 0.3);
+                color: #033cd2;
+                text-decoration: none;
+                overflow: hidden;
+                transition: background-color 0.4s;
+            }
+            .site:hover {
+                background-color: #033cd2;
+                color: white;
+            }
+            .site-title {
+                font-weight: bold;
+                white-space: nowrap;
+                overflow: hidden;
+                text-overflow: ellipsis;
+            }
+            .site-host {
+                font-size: small;
+            }
+            .empty {
+                text-align: center;
+                color: #808080;
+            }
+        </style>
+    </head>
+    <body>
+        %(content)s
+    </body>
+</html>
+'''
+
+_SITE = '''<a class="site" href="%(uri)s">
+            <div class="site-title">%(title)s</div>
+            <div class="site-host">%(host)s</div>
+        </a>'''
+
+
+def register(context):
+    ''' Serve the top sites page from the WebKit2.WebContext '''
+    context.register_uri_scheme(SCHEME, _request_cb)
+
+
+def _request_cb(request):
+    if request.get_uri() != URI:
+        request.finish_error(GLib.Error(_('Page not found: %s') %
+                                        request.get_uri()))
+        return
+
+    data = _build_page().encode('utf-8')
+    stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+    request.finish(stream, len(data), 'text/html')
+
+
+def _build_page():
+    sites = []
+    for uri, title, host in places.get_store().get_top_hosts(MAX_SITES):
+        sites.append(_SITE % {'uri': escape(uri),
+                              'title': escape(title or host),
+                              'host': escape(host)})
+
+    if sites:
+        content = '<div class="sites">%s</div>' % '\n'.join(sites)
+    else:
+        content = '<p class="empty">%s</p>' % \
+            escape(_('The sites you visit most will be shown here.'))
+
+    return _PAGE % {'title': escape(_('Top Sites')), 'content': content}
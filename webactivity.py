@@ -36,15 +36,17 @@ GObject.threads_init()
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import Gio
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
 from gi.repository import WebKit2
 from gi.repository import Soup
 
-from base64 import b64decode, b64encode
+from base64 import b64encode
 import time
 import shutil
 import json
 import cairo
-import io
+import threading
 from hashlib import sha1
 
 from sugar3.activity import activity
@@ -65,6 +67,10 @@ from widgets import TitledTray
 PROFILE_VERSION = 2
 
 THUMB_WIDTH, THUMB_HEIGHT = style.zoom(100), style.zoom(80)
+# The thumbnails are sent to the buddies, so keep them small
+THUMB_QUALITY = 75
+THUMB_MIN_QUALITY = 30
+THUMB_MAX_SIZE = 6 * 1024
 
 _profile_version = 0
 _profile_path = os.path.join(activity.get_activity_root(), 'data/gecko')
@@ -94,6 +100,19 @@ if _profile_version < PROFILE_VERSION:
     f.close()
 
 
+def _encode_thumb(pixbuf):
+    ''' Encode a thumbnail as JPEG, lowering the quality until it fits
+    in THUMB_MAX_SIZE
+    '''
+    quality = THUMB_QUALITY
+    while True:
+        success, data = pixbuf.save_to_bufferv(
+            'jpeg', ['quality'], [str(quality)])
+        if len(data) <= THUMB_MAX_SIZE or quality <= THUMB_MIN_QUALITY:
+            return data
+        quality = max(THUMB_MIN_QUALITY, quality - 15)
+
+
 def _seed_xs_cookie(cookie_jar):
     """Create a HTTP Cookie to authenticate with the Schoolserver.
 
@@ -138,11 +157,13 @@ from webtoolbar import PrimaryToolbar
 from edittoolbar import EditToolbar
 from viewtoolbar import ViewToolbar
 import downloadmanager
+import globalhistory
+import topsites
 
 # TODO: make the registration clearer SL #3087
 
-from model import Model
-from linkbutton import LinkButton
+from model import Model, reconcile, export_link, encode_wire_thumb
+from linkbutton import LinkTray
 
 SERVICE = "org.laptop.WebActivity"
 IFACE = SERVICE
@@ -182,6 +203,8 @@ class WebActivity(activity.Activity):
         cookie_manager.set_persistent_storage(
             _cookies_db_path, WebKit2.CookiePersistentStorage.SQLITE)
 
+        topsites.register(context)
+
         # FIXME
         # downloadmanager.remove_old_parts()
         context.connect('download-started', self.__download_requested_cb)
@@ -190,13 +213,20 @@ class WebActivity(activity.Activity):
         self._tabbed_view.connect('focus-url-entry', self._on_focus_url_entry)
         self._tabbed_view.connect('switch-page', self.__switch_page_cb)
 
-        self._titled_tray = TitledTray(_('Bookmarks'))
-        self._tray = self._titled_tray.tray
+        self.model = Model()
+        # The links waiting for their thumbnail
+        self._pending_links = set()
+
+        self._tray = LinkTray(self.model)
+        self._tray.connect('link-clicked', self._link_clicked_cb)
+        self._tray.connect('remove-link', self.__link_removed_cb)
+        self._tray.connect('notes-changed', self.__link_notes_changed)
+        self._titled_tray = TitledTray(_('Bookmarks'), self._tray)
         self.set_tray(self._titled_tray, Gtk.PositionType.BOTTOM)
-        self._tray_links = {}
 
-        self.model = Model()
+        # After the tray, which shows the new links first
         self.model.add_link_signal.connect(self._add_link_model_cb)
+        self.model.add_links_signal.connect(self._add_links_model_cb)
 
         self._primary_toolbar = PrimaryToolbar(self._tabbed_view, self)
         self._edit_toolbar = EditToolbar(self)
@@ -228,6 +258,7 @@ class WebActivity(activity.Activity):
         self._tabbed_view.show()
 
         self.connect('key-press-event', self._key_press_cb)
+        self.connect('destroy', self.__destroy_cb)
 
         if handle.uri:
             self._tabbed_view.current_browser.load_uri(handle.uri)
@@ -263,6 +294,10 @@ class WebActivity(activity.Activity):
         # sure these are visible.  Don't make the user lost
         self._tabbed_view.set_show_tabs(True)
 
+    def __destroy_cb(self, widget):
+        # Write the visits that are still waiting in memory
+        globalhistory.get_global_history().close()
+
     def _cleanup_temp_files(self):
         """Removes temporary files generated by Download Manager that
         were cancelled by the user or failed for any reason.
@@ -317,16 +352,9 @@ class WebActivity(activity.Activity):
         if self.metadata['mime_type'] == 'text/plain':
             data = self._get_data_from_file_path(file_path)
             self.model.deserialize(data)
+            self._tray.update()
+            self._update_traybutton()
 
-            for link in self.model.data['shared_links']:
-                _logger.debug('read: url=%s title=%s d=%s' % (link['url'],
-                                                              link['title'],
-                                                              link['color']))
-                self._add_link_totray(link['url'],
-                                      b64decode(link['thumb']),
-                                      link['color'], link['title'],
-                                      link['owner'], -1, link['hash'],
-                                      link.get('notes'))
             logging.debug('########## reading %s', data)
             if 'session_state' in self.model.data:
                 self._tabbed_view.set_session_state(
@@ -362,6 +390,8 @@ class WebActivity(activity.Activity):
             _logger.debug('Called write_file before the tabbed_view was made')
             return
 
+        globalhistory.get_global_history().flush()
+
         if not self.metadata['mime_type']:
             self.metadata['mime_type'] = 'text/plain'
 
@@ -454,7 +484,7 @@ class WebActivity(activity.Activity):
                 browser.zoom_in()
                 return True
             if event.keyval == Gdk.KEY_t:
-                self._tabbed_view.add_tab()
+                self._tabbed_view.on_add_tab(None, None)
                 return True
             if event.keyval == Gdk.KEY_w:
                 self._tabbed_view.close_tab()
@@ -498,21 +528,74 @@ class WebActivity(activity.Activity):
         return False
 
     def _add_link(self):
-        ''' take screenshot and add link info to the model '''
+        ''' take a snapshot of the page, the link info is added to the
+        model once its thumbnail is ready
+        '''
 
         browser = self._tabbed_view.props.current_browser
         ui_uri = browser.get_uri()
 
-        if self.model.has_link(ui_uri):
+        if ui_uri is None or ui_uri in self._pending_links or \
+                self.model.has_link(ui_uri):
             return
 
-        buf = b64encode(self._get_screenshot()).decode('ascii')
-        timestamp = time.time()
-        args = (ui_uri, browser.props.title, buf,
-                profile.get_nick_name(),
+        self._pending_links.add(ui_uri)
+        info = (ui_uri, browser.props.title, time.time())
+        browser.get_snapshot(WebKit2.SnapshotRegion.VISIBLE,
+                             WebKit2.SnapshotOptions.NONE, None,
+                             self.__snapshot_cb, info)
+
+    def __snapshot_cb(self, browser, result, info):
+        try:
+            surface = browser.get_snapshot_finish(result)
+        except GLib.Error as error:
+            _logger.warning('Could not take a snapshot of %s: %s',
+                            info[0], error.message)
+            self.__thumb_ready_cb(info, None, None)
+            return
+
+        pixbuf = Gdk.pixbuf_get_from_surface(
+            surface, 0, 0, surface.get_width(), surface.get_height())
+        if pixbuf is None:
+            self.__thumb_ready_cb(info, None, None)
+            return
+
+        thread = threading.Thread(target=self._make_thumb,
+                                  args=(pixbuf, info), daemon=True)
+        thread.start()
+
+    def _make_thumb(self, pixbuf, info):
+        ''' Scale and encode the snapshot, in a worker thread
+
+        The thumbnail is stored as JPEG, and sent to the buddies as PNG,
+        which the previous versions of Browse read.
+        '''
+        data = wire_data = None
+        try:
+            thumb = pixbuf.scale_simple(THUMB_WIDTH, THUMB_HEIGHT,
+                                        GdkPixbuf.InterpType.BILINEAR)
+            data = _encode_thumb(thumb)
+            success, wire_data = thumb.save_to_bufferv('png', [], [])
+        except GLib.Error as error:
+            _logger.warning('Could not encode the thumbnail of %s: %s',
+                            info[0], error.message)
+        finally:
+            # The link is added, even without its thumbnail
+            GLib.idle_add(self.__thumb_ready_cb, info, data, wire_data)
+
+    def __thumb_ready_cb(self, info, data, wire_data):
+        uri, title, timestamp = info
+        self._pending_links.discard(uri)
+        if self.model.has_link(uri):
+            return False
+
+        buf = b64encode(data).decode('ascii') if data else ''
+        args = (uri, title, buf, profile.get_nick_name(),
                 profile.get_color().to_string(), timestamp)
         self.model.add_link(*args, by_me=True)
+        args = args[:2] + (encode_wire_thumb(wire_data),) + args[3:]
         self._collab.post({'type': 'add_link', 'args': args})
+        return False
 
     def __message_cb(self, collab, buddy, message):
         type_ = message.get('type')
@@ -524,96 +607,67 @@ class WebActivity(activity.Activity):
             self.remove_link(message['hash'])
 
     def get_data(self):
-        return self.model.data
+        # The buddies don't have the thumbnails in their store
+        data = dict(self.model.data)
+        data['shared_links'] = [export_link(link)
+                                for link in self.model.data['shared_links']]
+        return data
 
     def set_data(self, data):
-        for link in data['shared_links']:
-            if link['hash'] not in self.model.get_links_ids():
-                self.model.add_link_from_info(link)
+        to_add, to_push, conflicts = reconcile(
+            self.model.data['shared_links'], data['shared_links'])
+        self.model.add_links_from_info(to_add)
+
+        for link, their_link in conflicts:
             # FIXME: Case where buddy has updated link desciption
+            _logger.debug('Notes of %s differ from the ones of a buddy',
+                          link['url'])
 
-        their_model = Model()
-        their_model.data = data
-        for link in self.model.data['shared_links']:
-            if link['hash'] not in their_model.get_links_ids():
-                self._collab.post({'type': 'add_link_from_info',
-                                   'dict': link})
+        for link in to_push:
+            self._collab.post({'type': 'add_link_from_info',
+                               'dict': export_link(link)})
 
     def _add_link_model_cb(self, model, index, by_me):
         ''' receive index of new link from the model '''
-        link = self.model.data['shared_links'][index]
-        widget = self._add_link_totray(
-            link['url'], b64decode(link['thumb']),
-            link['color'], link['title'],
-            link['owner'], index, link['hash'],
-            link.get('notes'))
+        self._update_traybutton()
 
-        if by_me:
+        link = self.model.data['shared_links'][index]
+        widget = self._tray.show_link(link['hash'])
+        if by_me and widget is not None:
             animator = Animator(1, widget=self)
             animator.add(AddLinkAnimation(
                 self, self._tabbed_view.props.current_browser, widget))
             animator.start()
 
-    def _add_link_totray(self, url, buf, color, title, owner, index, hash,
-                         notes=None):
-        ''' add a link to the tray '''
-        item = LinkButton(buf, color, title, owner, hash, notes)
-        item.connect('clicked', self._link_clicked_cb, url)
-        item.connect('remove_link', self.__link_removed_cb)
-        item.notes_changed_signal.connect(self.__link_notes_changed)
-        # use index to add to the tray
-        self._tray_links[hash] = item
-        self._tray.add_item(item, index)
-        item.show()
-        self._view_toolbar.traybutton.props.sensitive = True
-        self._view_toolbar.traybutton.props.active = True
+    def _add_links_model_cb(self, model, start, end, by_me):
+        ''' receive the range of indexes of new links from the model '''
+        self._update_traybutton()
+
+    def _update_traybutton(self):
+        has_links = bool(self.model.data['shared_links'])
+        self._view_toolbar.traybutton.props.sensitive = has_links
+        self._view_toolbar.traybutton.props.active = has_links
         self._view_toolbar.update_traybutton_tooltip()
-        return item
 
     def __link_removed_cb(self, button, hash):
         self.remove_link(hash)
         self._collab.post({'type': 'remove_link', 'hash': hash})
 
     def remove_link(self, hash):
-        ''' remove a link from tray and delete it in the model '''
-        self._tray_links[hash].hide()
-        self._tray_links[hash].destroy()
-        del self._tray_links[hash]
-
+        ''' delete a link in the model, and so from the tray '''
         self.model.remove_link(hash)
-        if len(self._tray.get_children()) == 0:
-            self._view_toolbar.traybutton.props.sensitive = False
-            self._view_toolbar.traybutton.props.active = False
-            self._view_toolbar.update_traybutton_tooltip()
+        if not self.model.data['shared_links']:
+            self._update_traybutton()
 
-    def __link_notes_changed(self, button, hash, notes):
+    def __link_notes_changed(self, tray, hash, notes):
         self.model.change_link_notes(hash, notes)
 
-    def _link_clicked_cb(self, button, url):
+    def _link_clicked_cb(self, tray, url):
         ''' an item of the link tray has been clicked '''
         browser = self._tabbed_view.add_tab()
         browser.load_uri(url)
         browser.grab_focus()
 
-    def _get_screenshot(self):
-        browser = self._tabbed_view.props.current_browser
-        window = browser.get_window()
-        width, height = window.get_width(), window.get_height()
-
-        thumb_surface = Gdk.Window.create_similar_surface(
-            window, cairo.CONTENT_COLOR, THUMB_WIDTH, THUMB_HEIGHT)
-
-        cairo_context = cairo.Context(thumb_surface)
-        thumb_scale_w = THUMB_WIDTH * 1.0 / width
-        thumb_scale_h = THUMB_HEIGHT * 1.0 / height
-        cairo_context.scale(thumb_scale_w, thumb_scale_h)
-        Gdk.cairo_set_source_window(cairo_context, window, 0, 0)
-        cairo_context.paint()
-
-        thumb_str = io.BytesIO()
-        thumb_surface.write_to_png(thumb_str)
-        return thumb_str.getvalue()
-
     def can_close(self):
         if self._force_close:
             return True
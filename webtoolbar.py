@@ -166,18 +166,28 @@ class WebEntry(iconentry.IconEntry):
         return view
 
     def _search_update(self):
+        # The result is given to __search_done_cb from the main loop
+        places.get_store().search_async(self.props.text,
+                                        self.__search_done_cb)
+
+    def __search_done_cb(self, search_text, result):
+        if search_text != self.props.text or not self.is_focus():
+            return
+
         list_store = Gtk.ListStore(str, str)
 
-        search_text = self.props.text
-        for place in places.get_store().search(search_text):
+        for place in result:
             title = '<span weight="bold" >%s</span>' % \
                     (GLib.markup_escape_text(place.title))
-            place.uri = GLib.markup_escape_text(place.uri)
-            list_store.append([title + '\n' + place.uri, place.uri])
+            uri = GLib.markup_escape_text(place.uri)
+            list_store.append([title + '\n' + uri, uri])
 
         self._search_view.set_model(list_store)
 
-        return len(list_store) > 0
+        if len(list_store) > 0:
+            self._search_popup()
+        else:
+            self._search_popdown()
 
     def _search_popup(self):
         miss, window_x, window_y = self.props.window.get_origin()
@@ -199,6 +209,7 @@ class WebEntry(iconentry.IconEntry):
         self.get_parent().queue_draw()
 
     def _search_popdown(self):
+        places.get_store().cancel_search()
         self._search_window.hide()
         self.get_parent().get_style_context().remove_class('connected-entry')
         self.get_parent().queue_draw()
@@ -278,10 +289,10 @@ class WebEntry(iconentry.IconEntry):
     def __changed_cb(self, entry):
         self._address = self.props.text
 
-        if not self.props.text or not self._search_update():
+        if not self.props.text:
             self._search_popdown()
         else:
-            self._search_popup()
+            self._search_update()
 
 
 class UrlToolbar(Gtk.EventBox):
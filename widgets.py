@@ -123,9 +123,11 @@ class TitledTray(Gtk.Box):
 
     Args:
         title (str): title of the tray
+        tray (Gtk.Widget): the tray below the title bar, a new HTray
+            by default
     '''
 
-    def __init__(self, title):
+    def __init__(self, title, tray=None):
         Gtk.Box.__init__(self, orientation=Gtk.Orientation.VERTICAL)
 
         self._top_event_box = Gtk.EventBox()
@@ -155,7 +157,7 @@ class TitledTray(Gtk.Box):
         self._revealer = Gtk.Revealer(reveal_child=True)
         self.add(self._revealer)
         self._revealer.show()
-        self.tray = HTray()
+        self.tray = tray or HTray()
         self._revealer.add(self.tray)
         self.tray.show()
 